@@ -0,0 +1,91 @@
+import pandas as pd
+import numpy as np
+import multiprocessing
+import time
+import Tools as tools
+import CompareMethods as cm
+from affinegap import normalizedAffineGapDistance
+from simplecosine.cosine import CosineTextSimilarity
+
+
+def reference_affine_gap(s1, s2):
+    # compares each pair (former implementation of dedupe_affine_gap)
+    return pd.Series(list(zip(s1, s2))).apply(lambda x: normalizedAffineGapDistance(x[0], x[1]))
+
+
+def reference_cosine(s1, s2):
+    # compares each pair (former implementation of dedupe_cosine)
+    s1_2 = pd.Series(list(zip(s1, s2)))
+    corpus_set = []
+    for value in s1_2:
+        corpus_set.append(value[0])
+        corpus_set.append(value[1])
+    cosine = CosineTextSimilarity(corpus_set)
+    return s1_2.apply(lambda x: cosine(x[0], x[1]))
+
+
+def benchmark(method, s1, s2, extra_seconds=0):
+    """
+    calls the compare method and returns the result and the compared pairs per second
+    :param extra_seconds: seconds added to the runtime of the method (e.g. creating the cosine model)
+    """
+    start = time.perf_counter()
+    result = method(s1, s2)
+    return np.asarray(result, dtype=np.float64), len(s1) / (time.perf_counter() - start + extra_seconds)
+
+
+# ------------------------- main ------------------
+
+if __name__ == "__main__":
+    config = tools.get_config(None)
+    fieldname = config.common.fields[0].name
+    n_jobs = config.common.n_jobs if config.common.n_jobs > 1 else multiprocessing.cpu_count()
+
+    # init Random with a fixes seed (for reproducibility)
+    tools.init_random_with_seed()
+
+    # compare the matches and a sample of distincts (like CompareMethods.py)
+    df_1 = tools.load_file_as_df(config.common.filename_1, [fieldname])
+    df_2 = tools.load_file_as_df(config.common.filename_2, [fieldname])
+    idx_match = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
+    idx_distinct = tools.sample_pairs(df_1.index, df_2.index, len(idx_match) * 10, idx_match)
+    pairs = idx_match.append(idx_distinct)
+    s1 = pd.Series(cm.lookup_values(df_1[fieldname], pairs.get_level_values(0)))
+    s2 = pd.Series(cm.lookup_values(df_2[fieldname], pairs.get_level_values(1)))
+    print("{0} pairs, {1} distinct value pairs".format(len(pairs), len(set(zip(s1, s2)))))
+
+    references = {"dedupe_affine_gap": benchmark(reference_affine_gap, s1, s2),
+                  "dedupe_cosine": benchmark(reference_cosine, s1, s2)}
+
+    # the cosine model of the corpus of reference_cosine, so the workers of the pool use the same model.
+    # Creating the model is added to the runtime of dedupe_cosine
+    start = time.perf_counter()
+    cm.cosine_model = CosineTextSimilarity(
+        list(np.column_stack([np.asarray(s1, dtype=object), np.asarray(s2, dtype=object)]).ravel()))
+    cosine_seconds = time.perf_counter() - start
+
+    results = []
+    for jobs in sorted({1, n_jobs}):
+        # the pool is created once per run (like in CompareMethods.py), its start is reported separately
+        start = time.perf_counter()
+        pool = cm.create_compare_pool(jobs, cm.cosine_model) if jobs > 1 else None
+        pool_seconds = time.perf_counter() - start
+        try:
+            for name, method, extra_seconds in (("dedupe_affine_gap", cm.dedupe_affine_gap, 0),
+                                                ("dedupe_cosine", cm.dedupe_cosine, cosine_seconds)):
+                reference_result, reference_speed = references[name]
+                result, speed = benchmark(lambda x, y: method(x, y, pool), s1, s2, extra_seconds)
+                assert (np.array_equal(result, reference_result, equal_nan=True)), "{0} differs".format(name)
+                results.append({"method": name,
+                                "n_jobs": jobs,
+                                "per pair (pairs/s)": round(reference_speed),
+                                "distinct pairs (pairs/s)": round(speed),
+                                "speedup": round(speed / reference_speed, 2),
+                                "pool start (s)": round(pool_seconds, 3)})
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    print("")
+    print(pd.DataFrame(results).sort_values(["method", "n_jobs"]).to_string(index=False))
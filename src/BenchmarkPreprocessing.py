@@ -0,0 +1,45 @@
+import pandas as pd
+import timeit
+import Tools as tools
+
+
+def load_raw_file(filename):
+    # loads the data file without preprocessing
+    return pd.read_csv(filename, encoding="iso-8859-1", engine='c', skipinitialspace=True, index_col=[0])
+
+
+def benchmark_field(series, repeat):
+    """
+    runs pre_process_string per value and pre_process_series on the whole series,
+    checks that both results are identical and returns the best time of both methods
+    """
+    result_string = series.apply(lambda x: tools.pre_process_string(x))
+    result_series = tools.pre_process_series(series)
+    assert (result_string.tolist() == result_series.tolist()), "pre_process_series differs from pre_process_string"
+
+    time_string = min(timeit.repeat(lambda: series.apply(lambda x: tools.pre_process_string(x)), number=1, repeat=repeat))
+    time_series = min(timeit.repeat(lambda: tools.pre_process_series(series), number=1, repeat=repeat))
+    return time_string, time_series
+
+
+# ------------------------- main ------------------
+
+config = tools.get_config(None)
+fieldnames = sorted(set(cfg.name for cfg in config.common.fields))
+
+results = []
+for filename in (config.common.filename_1, config.common.filename_2):
+    df = load_raw_file(filename)
+    for fieldname in fieldnames:
+        print("Benchmarking {0} ({1})".format(filename, fieldname))
+        time_string, time_series = benchmark_field(df[fieldname], 5)
+        results.append({"file": filename,
+                        "field": fieldname,
+                        "values": len(df),
+                        "distinct values": df[fieldname].nunique(),
+                        "pre_process_string (s)": round(time_string, 6),
+                        "pre_process_series (s)": round(time_series, 6),
+                        "speedup": round(time_string / time_series, 2)})
+
+print("")
+print(pd.DataFrame(results).to_string(index=False))
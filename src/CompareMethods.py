@@ -1,31 +1,132 @@
 import pandas as pd
+import numpy as np
 import recordlinkage as rl
-import random as rnd
+import multiprocessing
 import Tools as tools
 from datetime import datetime
 from affinegap import normalizedAffineGapDistance
 from simplecosine.cosine import CosineTextSimilarity
 
-def dedupe_affine_gap(s1, s2):
-    return pd.Series(list(zip(s1, s2))).apply(lambda x: normalizedAffineGapDistance(x[0], x[1]))
+# count of value pairs compared by a worker process at once. The process pool is only used,
+# if more distinct value pairs are compared (smaller comparisons are faster without the pool)
+compare_chunk_size = 5000
 
-def dedupe_cosine(s1, s2):
-    s1_2 = pd.Series(list(zip(s1, s2)));
 
-    # build corpus
-    corpus_set = []
-    for index, value in s1_2.iteritems():
-        corpus_set.append(value[0])
-        corpus_set.append(value[1])
+def factorize_values(series):
+    """
+    returns the codes of the values and the distinct values.
+    missing values get their own code (the last distinct value)
+    """
+    codes, uniques = pd.factorize(series)
+    uniques = list(uniques)
+    missing = codes < 0
+    if missing.any():
+        uniques.append(series.values[np.flatnonzero(missing)[0]])
+        codes = np.where(missing, len(uniques) - 1, codes)
+    return codes, uniques
 
-    # init cosine instance
-    cosine = CosineTextSimilarity(corpus_set)
+
+# compare functions of the compare worker processes by name (set by init_compare_worker)
+compare_worker_data = {}
+
+
+def init_compare_worker(cosine):
+    """
+    initializes a compare worker process. The cosine model is passed once per worker process
+    """
+    compare_worker_data["affine_gap"] = normalizedAffineGapDistance
+    compare_worker_data["cosine"] = cosine
+
+
+def create_compare_pool(n_jobs, cosine):
+    """
+    creates the process pool of the dedupe compare methods, which is used for all compared pairs of a run
+    """
+    return multiprocessing.Pool(n_jobs, init_compare_worker, (cosine,))
+
+
+def compare_worker(task):
+    """
+    compares the value pairs of the task (compare function name, value pairs) in a worker process
+    """
+    function_name, value_pairs = task
+    compare_function = compare_worker_data[function_name]
+    return [compare_function(value_1, value_2) for value_1, value_2 in value_pairs]
+
+
+def compare_distinct_pairs(s1, s2, function_name, compare_function, pool=None):
+    """
+    calls compare_function for each distinct pair of values of s1 and s2 only once and
+    returns the result for all pairs. If a pool (see create_compare_pool) is passed and there are more than
+    compare_chunk_size distinct pairs, they are compared in chunks by the workers using the function_name
+    """
+    codes_1, values_1 = factorize_values(pd.Series(s1).reset_index(drop=True))
+    codes_2, values_2 = factorize_values(pd.Series(s2).reset_index(drop=True))
+    pair_codes, distinct_keys = pd.factorize(codes_1.astype(np.int64) * len(values_2) + codes_2)
+    value_pairs = [(values_1[key // len(values_2)], values_2[key % len(values_2)]) for key in distinct_keys]
+
+    if pool is not None and len(value_pairs) > compare_chunk_size:
+        chunks = [(function_name, value_pairs[i:i + compare_chunk_size])
+                  for i in range(0, len(value_pairs), compare_chunk_size)]
+        distinct_results = [result for chunk_result in pool.map(compare_worker, chunks) for result in chunk_result]
+    else:
+        distinct_results = [compare_function(value_1, value_2) for value_1, value_2 in value_pairs]
+
+    return pd.Series(np.array(distinct_results, dtype=np.float64).take(pair_codes))
+
+
+def dedupe_affine_gap(s1, s2, pool=None):
+    return compare_distinct_pairs(s1, s2, "affine_gap", normalizedAffineGapDistance, pool)
+
+
+# cosine model of the field values of both data files (set by load_cosine_model)
+cosine_model = None
+
+
+def load_cosine_model(df1, df2, fieldname, filename_1, filename_2, use_cache=True):
+    """
+    creates the cosine model using all values of the field in both data files as corpus,
+    so the same word weights are used for all compared pairs.
+    The model is stored in the data cache of filename_1
+    """
+    model = None
+    if use_cache:
+        cache_filename = tools.get_cache_filename(filename_1, "cosine " + fieldname, [fieldname], [filename_2])
+        model = tools.load_cache(cache_filename)
+
+    if model is None:
+        model = CosineTextSimilarity(list(df1[fieldname]) + list(df2[fieldname]))
+        if use_cache:
+            tools.save_cache(cache_filename, model)
+
+    # create the vectors of all values, so comparing a pair only needs vector lookups
+    for value in pd.unique(pd.concat([df1[fieldname], df2[fieldname]])):
+        if isinstance(value, str):
+            model.vectorize(value)
+
+    return model
+
+
+def dedupe_cosine(s1, s2, pool=None):
+    cosine = cosine_model
+    if cosine is None:
+        # build corpus (the values of both series)
+        corpus_set = list(np.column_stack([np.asarray(s1, dtype=object), np.asarray(s2, dtype=object)]).ravel())
+
+        # init cosine instance (the workers of the pool only know the cosine model of the pool)
+        cosine = CosineTextSimilarity(corpus_set)
+        pool = None
 
     # calc similarity
-    return s1_2.apply(lambda x: cosine(x[0], x[1]))
+    return compare_distinct_pairs(s1, s2, "cosine", cosine, pool)
 
 
-def run_compare(fieldname, df1, df2, index):
+def run_compare(fieldname, df1, df2, index, store_values=True, pool=None):
+    """
+    compares the field values of the pairs of the index with all compare methods.
+    If store_values is set, the compared values are added as columns file1 and file2.
+    The dedupe compare methods use the pool (see create_compare_pool), if it's passed
+    """
     # list of the string comparers
     compare_methods = ['jaro', 'jarowinkler', 'levenshtein', 'damerau_levenshtein', 'q_gram', 'cosine',
                        'smith_waterman', 'longest_common_substring']
@@ -36,27 +137,43 @@ def run_compare(fieldname, df1, df2, index):
        compare_cl.string(fieldname, fieldname, label='prlt_' + method, method=method, missing_value=0)
 
     # dedupe classes
-    compare_cl.compare_vectorized(dedupe_affine_gap, fieldname, fieldname, label='dedupe_affine_gap')
-    compare_cl.compare_vectorized(dedupe_cosine, fieldname, fieldname, label='dedupe_cosine')
+    compare_cl.compare_vectorized(dedupe_affine_gap, fieldname, fieldname, pool, label='dedupe_affine_gap')
+    compare_cl.compare_vectorized(dedupe_cosine, fieldname, fieldname, pool, label='dedupe_cosine')
 
     # calculate features
     features = compare_cl.compute(index, df1, df2)
 
-    # add the original values
-    features.insert(0, 'file1', '')
-    features.insert(1, 'file2', '')
-    for index, row in features.iterrows():
-        # set values for the row
-        features.loc[index, 'file1'] = df1.loc[index[0], fieldname]
-        features.loc[index, 'file2'] = df2.loc[index[1], fieldname]
+    # add the original values (looked up by the position of the ids in the data files)
+    if store_values:
+        features.insert(0, 'file1', lookup_values(df1[fieldname], features.index.get_level_values(0)))
+        features.insert(1, 'file2', lookup_values(df2[fieldname], features.index.get_level_values(1)))
 
     # return the created dataframe
     return features
 
-def save_binned_result(df_match, df_distinct, bin_count, filename_with_placeholder):
-    for col_name in list(df_match)[2:]:
-        df = tools.series_to_bins(df_match[col_name], df_distinct[col_name], bin_count, )
-        tools.save_csv(df, config.common.result_base_dir + filename_with_placeholder.format(col_name), index=False)
+def lookup_values(series, ids):
+    # returns the values of the series for the ids
+    positions = series.index.get_indexer(ids)
+    if (positions < 0).any():
+        raise KeyError("ids not found in the data file: {0}".format(list(ids[positions < 0][:5])))
+    return series.values.take(positions)
+
+
+def save_binned_result(df_match, df_distinct, bin_count, filename_with_placeholder, single_file=False):
+    """
+    saves the binned values of each compare method as file.
+    If single_file is set, the bins of all methods are saved in one file (placeholder = all)
+    """
+    columns = [x for x in list(df_match) if x not in ('file1', 'file2')]
+    binned = tools.dataframe_to_bins(df_match[columns], df_distinct[columns], bin_count)
+
+    if single_file:
+        df = pd.concat([df.rename(columns=lambda x: "{0} {1}".format(col_name, x)) for col_name, df in binned.items()],
+                       axis=1)
+        tools.save_csv(df, config.common.result_base_dir + filename_with_placeholder.format("all"), index=False)
+    else:
+        for col_name, df in binned.items():
+            tools.save_csv(df, config.common.result_base_dir + filename_with_placeholder.format(col_name), index=False)
 
 
 def save_result(df, filename):
@@ -64,45 +181,51 @@ def save_result(df, filename):
     df.to_csv(config.common.result_base_dir + filename)
 
 
-def sample_index(index, sample_count):
-    # extracts a sample from the index
-    return pd.MultiIndex.from_tuples(rnd.sample(list(index), sample_count))
-
-
 # ------------------------- main ------------------
 
-start_time = datetime.now()
+if __name__ == "__main__":
+    start_time = datetime.now()
+
+    # setup
+    config = tools.get_config(None)
+    assert (len(config.common.fields) == 1), "Only one Field is allowed for fields"
+    fieldname = config.common.fields[0].name
 
-# setup
-config = tools.get_config(None)
-assert (len(config.common.fields) == 1), "Only one Field is allowed for fields"
-fieldname = config.common.fields[0].name
+    tools.ensure_directories(config.common.result_base_dir + "dummy")
 
-tools.ensure_directories(config.common.result_base_dir + "dummy")
+    # init Random with a fixes seed (for reproducibility)
+    tools.init_random_with_seed()
 
-# init Random with a fixes seed (for reproducibility)
-tools.init_random_with_seed()
+    # load files
+    print("Loading files")
+    df_1 = tools.load_file_as_df(config.common.filename_1, [fieldname])
+    df_2 = tools.load_file_as_df(config.common.filename_2, [fieldname])
+    idx_match = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
+    cosine_model = load_cosine_model(df_1, df_2, fieldname, config.common.filename_1, config.common.filename_2)
 
-# load files
-print("Loading files")
-df_1 = tools.load_file_as_df(config.common.filename_1, [fieldname])
-df_2 = tools.load_file_as_df(config.common.filename_2, [fieldname])
-idx_match = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
+    # sample pairs without the matches
+    idx_distinct = tools.sample_pairs(df_1.index, df_2.index, len(idx_match) * 10, idx_match)
 
-# build a full index without the matches
-idx_full = rl.FullIndex().index(df_1, df_2)
-idx_distinct = sample_index(idx_full.difference(idx_match), len(idx_match) * 10)
+    # the process pool is created once and used to compare the matches and the distincts
+    compare_pool = None
+    if config.common.n_jobs > 1:
+        compare_pool = create_compare_pool(config.common.n_jobs, cosine_model)
 
-# run compare
-print("Compare matches")
-df_match = run_compare(fieldname, df_1, df_2, idx_match)
+    # run compare
+    try:
+        print("Compare matches")
+        df_match = run_compare(fieldname, df_1, df_2, idx_match, config.common.store_values, compare_pool)
 
-print("Compare distincts")
-df_distinct = run_compare(fieldname, df_1, df_2, idx_distinct)
+        print("Compare distincts")
+        df_distinct = run_compare(fieldname, df_1, df_2, idx_distinct, config.common.store_values, compare_pool)
+    finally:
+        if compare_pool is not None:
+            compare_pool.close()
+            compare_pool.join()
 
-# save result
-save_result(df_match, 'cm_matches.csv')
-save_result(df_distinct, 'cm_distinct.csv')
-save_binned_result(df_match, df_distinct, 25, 'cm_bin_{0}.csv')
+    # save result
+    save_result(df_match, 'cm_matches.csv')
+    save_result(df_distinct, 'cm_distinct.csv')
+    save_binned_result(df_match, df_distinct, 25, 'cm_bin_{0}.csv', config.common.single_bin_file)
 
-print('Time elapsed (hh:mm:ss.ms) {}'.format(datetime.now() - start_time))
+    print('Time elapsed (hh:mm:ss.ms) {}'.format(datetime.now() - start_time))
@@ -10,10 +10,18 @@ The output will be a CSV with our linked results.
 """
 import csv
 import logging
+import sys
+import time
+import os
+import io
+import json
+import importlib.metadata
+import pandas as pd
 import dedupe
 import Tools as tools
 import Evaluation as ev
 import random as rnd
+import numpy as np
 
 
 class Config_Item:
@@ -22,31 +30,54 @@ class Config_Item:
     """
     def __init__(self, json_item):
         self.golden_pairs_count = json_item["golden_pairs_count"]
+        # count of labeled pairs marked at once (the deduper retrains with each mark)
+        self.labeling_batch_size = json_item.get("labeling_batch_size", 1)
+        # score thresholds evaluated using the scored pairs
+        self.thresholds = json_item.get("thresholds", [])
+        # if set, the thresholds are evaluated using the scored pairs of a former run (without matching)
+        self.rethreshold = json_item.get("rethreshold", False)
+        # statistics of the blocked pairs of the linker: none, count or save (count and save as blocked_pairs.csv)
+        self.blocked_pairs = json_item.get("blocked_pairs", "none")
 
     def to_dict(self):
-        return dict({"golden_pairs_count": self.golden_pairs_count})
+        return dict({"golden_pairs_count": self.golden_pairs_count,
+                     "labeling_batch_size": self.labeling_batch_size})
 
 
 
-def load_data(filename, preprocessing_fieldnames):
+def load_data(filename, preprocessing_fieldnames, key_prefix):
     """
     Read in our data from a CSV file and create a dictionary of records, 
-    where the key is a unique record ID.
+    where the key is a unique record ID (key_prefix and the row number, so the keys of both files differ).
+    The records only contain the id and the preprocessed fields (see tools.CompactRecord).
+    The loaded data is cached (the key_prefix is part of the cache key)
     """
+    cache_filename = tools.get_cache_filename(filename, "dedupe records " + key_prefix, preprocessing_fieldnames)
+    data_d = tools.load_cache(cache_filename)
+    if data_d is not None:
+        return data_d
+
+    fieldnames = ["id"] + [fieldname for fieldname in preprocessing_fieldnames if fieldname != "id"]
+    preprocessing_fieldnames_set = set(preprocessing_fieldnames)
+    # the field positions are shared by all records
+    field_positions = dict((fieldname, position) for position, fieldname in enumerate(fieldnames))
 
-    data_d = {}
-    if preprocessing_fieldnames:
-        preprocessing_fieldnames_set = set(preprocessing_fieldnames)
-    else:
-        preprocessing_fieldnames_set = set()
     with open(filename) as csv_file:
-        reader = csv.DictReader(csv_file)
-        for i, row in enumerate(reader):
-            clean_row = dict([(k, v) for (k, v) in row.items()])
-            for fieldname in preprocessing_fieldnames_set:
-                clean_row[fieldname] = tools.pre_process_string(clean_row[fieldname])
-            data_d[filename + str(i)] = dict(clean_row)
+        rows = list(csv.DictReader(csv_file))
+
+    # the preprocessed fields are cleaned per column, so each distinct value is processed once
+    columns = []
+    for fieldname in fieldnames:
+        column = [row[fieldname] for row in rows]
+        if fieldname in preprocessing_fieldnames_set:
+            column = tools.pre_process_series(pd.Series(column, dtype=object)).tolist()
+        columns.append(column)
+
+    data_d = {}
+    for i, values in enumerate(zip(*columns)):
+        data_d[sys.intern(key_prefix + str(i))] = tools.CompactRecord(field_positions, values)
 
+    tools.save_cache(cache_filename, data_d)
     return data_d
 
 
@@ -60,6 +91,131 @@ def build_corpus(fieldname):
     return corpus_set
 
 
+# count of the record pairs sampled for the training of the linker
+SAMPLE_SIZE = 15000
+
+
+def get_dedupe_version():
+    # dedupe has no __version__, so the version of the installed package is used
+    try:
+        return importlib.metadata.version("dedupe")
+    except importlib.metadata.PackageNotFoundError:
+        return getattr(dedupe, "__version__", "")
+
+
+def get_model_cache_filename(config_item):
+    """
+    returns the model cache file of the config item. The key contains the dedupe version, the hashes of the data files,
+    the fields, the seed (and PYTHONHASHSEED) and the training settings of the config item
+    """
+    kind = "dedupe model|{0}|{1}|{2}|{3}|{4}|{5}|{6}".format(
+        get_dedupe_version(), json.dumps([(cfg.name, cfg.type) for cfg in config.common.fields]),
+        tools.RANDOM_SEED, os.environ.get("PYTHONHASHSEED", ""), SAMPLE_SIZE,
+        config_item.golden_pairs_count, config_item.labeling_batch_size)
+    return tools.get_cache_filename(config.common.filename_1, kind, fieldnames,
+                                    [config.common.filename_2, config.common.filename_perfect_match])
+
+
+def get_model_key(config_item):
+    """
+    returns the name of the model cache file of the config item, which identifies the data, fields
+    and training settings of the scored pairs (the data files are hashed once per run, see tools.hash_file)
+    """
+    return os.path.basename(get_model_cache_filename(config_item))
+
+
+def create_linker(config_item):
+    """
+    Creates and trains the linker of the config item.
+    If the model cache is enabled, the trained settings and the labeling statistics are cached,
+    so repeated runs load a StaticRecordLink instead of training the linker again
+    :return: linker, dictionary containing the labeling statistics
+    """
+    cache_filename = None
+    if config.common.model_cache:
+        cache_filename = get_model_cache_filename(config_item)
+        model = tools.load_cache(cache_filename)
+        if model is not None:
+            print('loading the trained linker from the model cache...')
+            return dedupe.StaticRecordLink(io.BytesIO(model["settings"])), dict(model["labeling_statistics"],
+                                                                                 Model_cache_hit=True)
+
+    # ## Training
+
+    # Create a new linker object and pass our data model to it.
+    new_linker = dedupe.RecordLink(fields)
+    # To train the linker, we feed it a sample of records.
+    new_linker.sample(data_1, data_2, SAMPLE_SIZE)
+
+    # ## Active learning
+    # Dedupe will find the next pair of records
+    # it is least certain about and ask you to label them as matches or not.
+    print('starting active labeling...')
+
+    # dedupe.consoleLabel(new_linker)
+    labeling_statistics = train_with_perfect_match(new_linker, config_item.golden_pairs_count, perfect_match_set,
+                                                   config_item.labeling_batch_size)
+
+    new_linker.train()
+
+    if cache_filename:
+        settings_file = io.BytesIO()
+        new_linker.writeSettings(settings_file)
+        tools.save_cache(cache_filename, {"settings": settings_file.getvalue(),
+                                          "labeling_statistics": labeling_statistics})
+
+    return new_linker, dict(labeling_statistics, Model_cache_hit=False)
+
+
+def save_scored_pairs(dirname, record_pairs, model_key):
+    """
+    Saves the scored pairs (list of [id1, id2, score]) as match arrays (see ev.MatchArrayWriter)
+    with the float32 column "Score". The model_key is stored in meta.json (see has_scored_pairs)
+    :return: match_index, scores of the pairs
+    """
+    match_index = pd.MultiIndex.from_arrays([[str(record[0]) for record in record_pairs],
+                                             [str(record[1]) for record in record_pairs]], names=["id1", "id2"])
+    scores = np.array([float(record[2]) for record in record_pairs], dtype=np.float32)
+
+    match_writer = ev.MatchArrayWriter(dirname, pd.Index([str(record["id"]) for record in data_1.values()]).unique(),
+                                       pd.Index([str(record["id"]) for record in data_2.values()]).unique(),
+                                       ["Score"], "float32", {"model_key": model_key})
+    match_writer.append(match_index, pd.DataFrame({"Score": scores}, index=match_index))
+    match_writer.close()
+    return match_index, scores
+
+
+def has_scored_pairs(dirname, model_key):
+    """
+    returns True, if dirname contains scored pairs saved with the model_key,
+    so the scored pairs are based on the same data, fields and training settings
+    """
+    if not os.path.isfile(os.path.join(dirname, "meta.json")):
+        return False
+    return ev.read_match_arrays_meta(dirname).get("model_key") == model_key
+
+
+def evaluate_thresholds(config_index, match_index, scores, thresholds, add_data):
+    """
+    Evaluates the scored pairs for each threshold and writes the match file of each threshold.
+    The pairs are sorted by score once, the matches of a threshold are the leading pairs of the sorted pairs
+    :return: list of evaluation results
+    """
+    order = np.argsort(-scores, kind="mergesort")
+    sorted_index = match_index[order]
+    sorted_scores = scores[order]
+    results = evaluator.evaluate_thresholds(sorted_index, sorted_scores, thresholds, add_data, presorted=True)
+
+    for threshold, result in zip(thresholds, results):
+        match_count = result["Match Count"]
+        pd.DataFrame({"idFile1": sorted_index.get_level_values(0)[:match_count],
+                      "idFile2": sorted_index.get_level_values(1)[:match_count],
+                      "Score": sorted_scores[:match_count]}).to_csv(
+            config.common.get_result_file_name(config_index, "result_threshold_{}.csv".format(threshold)),
+            index=False, float_format="%.6f")
+    return results
+
+
 def count_matches(deduper):
     # Returns the number of match training pairs
     return len(deduper.training_pairs['match'])
@@ -70,9 +226,29 @@ def count_distinct(deduper):
     return len(deduper.training_pairs['distinct'])
 
 
-def train_with_perfect_match(deduper, max_count, idx_perfect_match):
+def train_with_perfect_match(deduper, max_count, perfect_match_set, batch_size=1):
+    """
+    Labels the uncertain pairs of the deduper using the perfect matches, until max_count matches
+    and max_count distincts are labeled. The labeled pairs are marked in batches of batch_size pairs,
+    because the deduper retrains its active learner with each mark
+    :param perfect_match_set: set of the (id1, id2) tuples of the perfect matches
+    :return: dictionary containing the count of consumed uncertain pairs and the retrain times
+    """
+    match_count = count_matches(deduper)
+    distinct_count = count_distinct(deduper)
+    examples = {'distinct': [], 'match': []}
+    uncertain_pair_count = 0
+    retrain_seconds = []
+
+    def mark_examples():
+        start = time.perf_counter()
+        deduper.markPairs(examples)
+        retrain_seconds.append(time.perf_counter() - start)
+        print("marked {0} matches and {1} distincts in {2:.3f} s".format(
+            len(examples['match']), len(examples['distinct']), retrain_seconds[-1]))
+
     pairs = []
-    while True:
+    while match_count < max_count or distinct_count < max_count:
         # get next pair
         if not pairs:
             try:
@@ -82,41 +258,102 @@ def train_with_perfect_match(deduper, max_count, idx_perfect_match):
                 break
 
         record_pair = pairs.pop()
+        uncertain_pair_count += 1
+
+        # check if the key is a match
+        key = (str(record_pair[0]["id"]), str(record_pair[1]["id"]))
+        # the deduper keeps the labeled pairs as training pairs (written as json), so the records are marked as dicts
+        record_pair = (dict(record_pair[0]), dict(record_pair[1]))
+        if key in perfect_match_set:
+            if match_count < max_count:
+                examples['match'].append(record_pair)
+                match_count += 1
+        elif distinct_count < max_count:
+            examples['distinct'].append(record_pair)
+            distinct_count += 1
 
-        # build key
-        ids = []
-        for pair in record_pair:
-            ids.append(str(pair["id"]))
-        key = (ids[0], ids[1])
+        if len(examples['match']) + len(examples['distinct']) >= batch_size:
+            mark_examples()
+            examples = {'distinct': [], 'match': []}
 
-        # check if key is match
-        is_match = key in idx_perfect_match
+    if len(examples['match']) + len(examples['distinct']) > 0:
+        mark_examples()
 
-        examples = {'distinct': [], 'match': []}
-        if is_match and count_matches(deduper) < max_count:
-            examples['match'].append(record_pair)
-        elif not is_match and count_distinct(deduper) < max_count:
-            examples['distinct'].append(record_pair)
-        # add classified pair to list
-        if len(examples['match']) + len(examples['distinct']) > 0:
-            deduper.markPairs(examples)
+    return {"Labeling_uncertain_pairs": uncertain_pair_count,
+            "Labeling_retrain_steps": len(retrain_seconds),
+            "Labeling_retrain_seconds": sum(retrain_seconds)}
+
+
+def get_blocked_positions_from_linker():
+    """
+    Generator of the blocked pairs of the linker. Yields the positions (in data_1 and data_2) of the
+    pairs of each block as two arrays. Pairs of former blocks are removed using a PairKeySet,
+    so each pair is yielded once
+    """
+    record_positions_1 = dict((record_id, position) for position, record_id in enumerate(data_1))
+    record_positions_2 = dict((record_id, position) for position, record_id in enumerate(data_2))
+    pair_key_set = tools.PairKeySet(len(data_2))
 
-        # stop, when enough matches and distincts are defined
-        if count_matches(deduper) == max_count and \
-                count_distinct(deduper) == max_count:
-            break
+    for block in linker._blockData(data_1, data_2):
+        positions_1 = np.array([record_positions_1[item[0]] for item in block[0]], dtype=np.int64)
+        positions_2 = np.array([record_positions_2[item[0]] for item in block[1]], dtype=np.int64)
+        pairs_1 = np.repeat(positions_1, len(positions_2))
+        pairs_2 = np.tile(positions_2, len(positions_1))
+        is_new = pair_key_set.add(pairs_1, pairs_2)
+        if is_new.any():
+            yield pairs_1[is_new], pairs_2[is_new]
 
 
 def get_pairs_from_linker():
-    result_pair_tuple_list = list()
-    for item in linker._blockData(data_1, data_2):
-        for item1 in item[0]:
-            id1 = str(item1[1]["id"])
-            for item2 in item[1]:
-                id2 = str(item2[1]["id"])
-                result_pair_tuple_list.append((id1, id2))
+    """
+    Generator of the blocked pairs of the linker as (id1, id2) tuples. Each pair is yielded once
+    """
+    ids_1 = [str(record["id"]) for record in data_1.values()]
+    ids_2 = [str(record["id"]) for record in data_2.values()]
+    for positions_1, positions_2 in get_blocked_positions_from_linker():
+        for position_1, position_2 in zip(positions_1, positions_2):
+            yield ids_1[position_1], ids_2[position_2]
 
-    return result_pair_tuple_list
+
+def count_pairs_from_linker(pairs_filename=None):
+    """
+    Counts the blocked pairs of the linker without collecting the pairs.
+    If pairs_filename is set, the pairs are written to this csv file (like the result file without score).
+    The keys are named like the index statistics of the PythonRecordLinkageToolkit.py script
+    :return: dictionary containing the count of pairs, the count of perfect matches in the pairs and the reduction ratio
+    """
+    ids_1 = [str(record["id"]) for record in data_1.values()]
+    ids_2 = [str(record["id"]) for record in data_2.values()]
+    # positions of the perfect match pairs, whose records are loaded
+    record_positions_1 = dict((record_id, position) for position, record_id in enumerate(ids_1))
+    record_positions_2 = dict((record_id, position) for position, record_id in enumerate(ids_2))
+    perfect_match_keys = set()
+    for id_1, id_2 in index_perfect_match:
+        if id_1 in record_positions_1 and id_2 in record_positions_2:
+            perfect_match_keys.add(record_positions_1[id_1] * len(data_2) + record_positions_2[id_2])
+    perfect_match_keys = np.array(sorted(perfect_match_keys), dtype=np.int64)
+
+    pair_count = 0
+    perfect_match_count = 0
+    pairs_file = None
+    if pairs_filename:
+        pairs_file = open(pairs_filename, 'w', newline='')
+        writer = csv.writer(pairs_file)
+        writer.writerow(["idFile1", "idFile2"])
+    try:
+        for positions_1, positions_2 in get_blocked_positions_from_linker():
+            pair_count += len(positions_1)
+            perfect_match_count += int(np.isin(positions_1 * len(data_2) + positions_2, perfect_match_keys).sum())
+            if pairs_file:
+                writer.writerows((ids_1[position_1], ids_2[position_2])
+                                 for position_1, position_2 in zip(positions_1, positions_2))
+    finally:
+        if pairs_file:
+            pairs_file.close()
+
+    return {"Indexed_pairs": pair_count,
+            "Indexed_pairs_perfect_match": perfect_match_count,
+            "Reduction_ratio": 1 - pair_count / (len(data_1) * len(data_2))}
 
 
 # ---------------------- main ----------------------
@@ -133,9 +370,12 @@ fieldnames = []
 for cfg in config.common.fields:
     fieldnames.append(cfg.name)
 
-data_1 = load_data(config.common.filename_1, fieldnames)
-data_2 = load_data(config.common.filename_2, fieldnames)
+data_1 = load_data(config.common.filename_1, fieldnames, "a")
+data_2 = load_data(config.common.filename_2, fieldnames, "b")
 index_perfect_match = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
+evaluator = ev.MatchEvaluator(index_perfect_match)
+# the labeling checks each uncertain pair, so the perfect matches are hashed once
+perfect_match_set = set(index_perfect_match)
 
 # Define the fields the linker will pay attention to
 fields = []
@@ -154,79 +394,98 @@ for config_index, config_item in enumerate(config.items):
     # init Random with a fixes seed (for reproducibility)
     tools.init_random_with_seed()
 
-    # ## Training
-
-    # Create a new linker object and pass our data model to it.
-    linker = dedupe.RecordLink(fields)
-    # To train the linker, we feed it a sample of records.
-    linker.sample(data_1, data_2, 15000)
-
-
-    # ## Active learning
-    # Dedupe will find the next pair of records
-    # it is least certain about and ask you to label them as matches or not.
-    print('starting active labeling...')
-
-    # dedupe.consoleLabel(linker)
-    train_with_perfect_match(linker, config_item.golden_pairs_count, index_perfect_match)
-
-    linker.train()
-
-    # ## Blocking
-
-    # ## Clustering
-
-    # Find the threshold that will maximize a weighted average of our
-    # precision and recall.  When we set the recall weight to 2, we are
-    # saying we care twice as much about recall as we do precision.
-    #
-    # If we had more data, we would not pass in all the blocked data into
-    # this function but a representative sample.
-
-    print('clustering...')
-    linked_records = linker.match(data_1, data_2, 0)
-
-    # ## Writing Results
-
-    # Write our original data back out to a CSV with a new column called
-    # 'Cluster ID' which indicates which records refer to each other.
-
-    record_pairs = []
-    cluster_membership = {}
-    cluster_id = None
-    for cluster_id, (cluster, score) in enumerate(linked_records):
-        match_data_1 = []
-        match_data_2 = []
-        for record_id in cluster:
-            cluster_membership[record_id] = (cluster_id, score)
-            # search the original ID in the Dataset
-            if record_id in data_1:
-                match_data_1.append(data_1[record_id]["id"])
-            elif record_id in data_2:
-                match_data_2.append(data_2[record_id]["id"])
-
-        if len(match_data_1) > 0 and len(match_data_2) > 0:
-            for match_1 in match_data_1:
-                for match_2 in match_data_2:
-                    record_pairs.append([match_1, match_2, "{:.6f}".format(score)])
-
-    # Create Mapping File that can be compared to PerfectMapping
-    filename_result = config.common.get_result_file_name(config_index, 'result.csv')
-    with open(filename_result, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["idFile1", "idFile2", "Score"])
-        for record in record_pairs:
-            writer.writerow(record)
-
-    # Evaluating
-    filename_result = config.common.get_result_file_name(config_index, 'result.csv')
     add_data = dict({"classifier": "dedupe"}, **config_item.to_dict())
     add_data["classifier"] = "dedupe"
     add_data["config_name"] = config.common.config_name
     add_data["config_item_index"] = config_index
     add_data["fields"] = config.common.fields_to_string()
 
-    result_eval = ev.evaluate_match_file(filename_result, index_perfect_match, additional_data=add_data)
-
-    ev.print_evaluate_result(result_eval, "Evaluation")
-    ev.save_results(config.common.result_base_dir + "log.csv", result_eval)
+    scored_pairs_dirname = config.common.get_result_file_name(config_index, 'scored_pairs')
+    rethreshold = config_item.rethreshold and has_scored_pairs(scored_pairs_dirname, get_model_key(config_item))
+    if config_item.rethreshold and not rethreshold:
+        print('no scored pairs of the same data and settings found, running the linker...')
+    if rethreshold:
+        # ## Re-thresholding
+        print('loading the scored pairs...')
+        scored_index, scored_pairs = ev.read_match_arrays(scored_pairs_dirname, mmap_mode=None)
+        scores = scored_pairs["Score"].values
+    else:
+        # ## Training
+        linker, labeling_statistics = create_linker(config_item)
+
+        blocked_pairs_statistics = {}
+        if config_item.blocked_pairs == "count":
+            print('counting blocked pairs...')
+            blocked_pairs_statistics = count_pairs_from_linker()
+        elif config_item.blocked_pairs == "save":
+            print('saving blocked pairs...')
+            blocked_pairs_statistics = count_pairs_from_linker(
+                config.common.get_result_file_name(config_index, 'blocked_pairs.csv'))
+        elif config_item.blocked_pairs != "none":
+            raise ValueError("blocked_pairs {0} is invalid: must be none, count or save".format(config_item.blocked_pairs))
+
+        # ## Blocking
+
+        # ## Clustering
+
+        # Find the threshold that will maximize a weighted average of our
+        # precision and recall.  When we set the recall weight to 2, we are
+        # saying we care twice as much about recall as we do precision.
+        #
+        # If we had more data, we would not pass in all the blocked data into
+        # this function but a representative sample.
+
+        print('clustering...')
+        linked_records = linker.match(data_1, data_2, 0)
+
+        # ## Writing Results
+
+        # Write our original data back out to a CSV with a new column called
+        # 'Cluster ID' which indicates which records refer to each other.
+
+        record_pairs = []
+        cluster_membership = {}
+        cluster_id = None
+        for cluster_id, (cluster, score) in enumerate(linked_records):
+            match_data_1 = []
+            match_data_2 = []
+            for record_id in cluster:
+                cluster_membership[record_id] = (cluster_id, score)
+                # search the original ID in the Dataset
+                if record_id in data_1:
+                    match_data_1.append(data_1[record_id]["id"])
+                elif record_id in data_2:
+                    match_data_2.append(data_2[record_id]["id"])
+
+            if len(match_data_1) > 0 and len(match_data_2) > 0:
+                for match_1 in match_data_1:
+                    for match_2 in match_data_2:
+                        record_pairs.append([match_1, match_2, "{:.6f}".format(score)])
+
+        # Create Mapping File that can be compared to PerfectMapping
+        filename_result = config.common.get_result_file_name(config_index, 'result.csv')
+        with open(filename_result, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["idFile1", "idFile2", "Score"])
+            for record in record_pairs:
+                writer.writerow(record)
+
+        # Evaluating
+        filename_result = config.common.get_result_file_name(config_index, 'result.csv')
+        add_data.update(labeling_statistics)
+        add_data.update(blocked_pairs_statistics)
+
+        result_eval = ev.evaluate_match_file(filename_result, index_perfect_match, additional_data=add_data)
+
+        ev.print_evaluate_result(result_eval, "Evaluation")
+        ev.save_results(config.common.result_base_dir + "log.csv", result_eval)
+
+        # store the scored pairs for the re-thresholding
+        scored_index, scores = save_scored_pairs(scored_pairs_dirname, record_pairs, get_model_key(config_item))
+
+    if config_item.thresholds:
+        for result_eval in evaluate_thresholds(config_index, scored_index, scores, config_item.thresholds, add_data):
+            ev.print_evaluate_result(result_eval, "Evaluation (Threshold {0})".format(result_eval["Threshold"]))
+            ev.save_results(config.common.result_base_dir + "log.csv", result_eval)
+
+ev.export_results(config.common.result_base_dir + "log.csv")
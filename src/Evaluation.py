@@ -1,6 +1,10 @@
 import pandas as pd
+import numpy as np
 import os
 import datetime
+import sqlite3
+import json
+import shutil
 
 def evaluate_match_file(match_filename, perfect_match_index, additional_data=None):
     """
@@ -9,18 +13,158 @@ def evaluate_match_file(match_filename, perfect_match_index, additional_data=Non
     :param perfect_match_index: multindex containing the perfect match id's
     :return: a dictionary containing "perfect_match_total", "match_correct", "match_incorrect"
     """
+    if os.path.isdir(match_filename):
+        # match arrays directory (see MatchArrayWriter)
+        return evaluate_match_index(read_match_array_index(match_filename), perfect_match_index, additional_data)
+
     if not os.path.isfile(match_filename):
         return {}
 
-    # load matches and create a list of tuples
-    match_tuples = []
-    for index, row in pd.read_csv(match_filename, converters={0: str, 1: str}).iterrows():
-        match_tuples.append((row[0], row[1]))
-    match_index = pd.MultiIndex.from_tuples(match_tuples, names=["id1", "id2"])
+    # load the id columns of the matches as multiIndex
+    match_index = read_match_index(pd.read_csv(match_filename, usecols=[0, 1], dtype=str, keep_default_na=False))
 
     return evaluate_match_index(match_index, perfect_match_index, additional_data)
 
 
+def evaluate_match_file_chunked(match_filename, perfect_match_index, additional_data=None, chunk_size=100000):
+    """
+    evaluates the found matches like evaluate_match_file, but reads the match file in chunks of chunk_size rows.
+    Only the perfect_match_index and one chunk are held in memory
+    :return: a dictionary containing "perfect_match_total", "match_correct", "match_incorrect"
+    """
+    if not os.path.isfile(match_filename):
+        return {}
+
+    match_counter = MatchCounter(MatchEvaluator(perfect_match_index))
+    for chunk in pd.read_csv(match_filename, usecols=[0, 1], dtype=str, keep_default_na=False, chunksize=chunk_size):
+        match_counter.add(read_match_index(chunk))
+
+    return match_counter.evaluate(additional_data)
+
+
+def read_match_index(df):
+    """
+    returns the first two columns of the match dataframe as multiindex
+    """
+    return pd.MultiIndex.from_arrays([df.iloc[:, 0].values, df.iloc[:, 1].values], names=["id1", "id2"])
+
+
+class MatchCsvWriter:
+    """
+    Writes matches and their features as csv file. The matches can be appended in chunks
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = True
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    def append(self, match_index, features):
+        pd.DataFrame(features, match_index).to_csv(self.filename, mode="a", header=self.header)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class MatchArrayWriter:
+    """
+    Writes matches and their features as binary NumPy arrays into the directory dirname:
+    ids_1.npy, ids_2.npy: lookup tables of the record ids
+    codes_1.bin, codes_2.bin: positions of the match ids in the lookup tables (int32)
+    features.bin: feature matrix of the matches (row major, dtype of feature_dtype)
+    meta.json: columns, feature_dtype and count of the matches (and the entries of the dictionary meta)
+    The matches can be appended in chunks. Use read_match_arrays to load them
+    """
+    def __init__(self, dirname, ids_1, ids_2, columns, feature_dtype="float32", meta=None):
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.makedirs(dirname)
+        self.dirname = dirname
+        self.ids_1 = pd.Index(ids_1)
+        self.ids_2 = pd.Index(ids_2)
+        self.columns = [str(column) for column in columns]
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.meta = dict(meta or {})
+        self.count = 0
+        np.save(os.path.join(dirname, "ids_1.npy"), self.ids_1.values.astype(str))
+        np.save(os.path.join(dirname, "ids_2.npy"), self.ids_2.values.astype(str))
+        self.files = [open(os.path.join(dirname, name), "wb") for name in ("codes_1.bin", "codes_2.bin", "features.bin")]
+
+    def append(self, match_index, features):
+        """
+        appends the matches and their features (dataframe containing the rows of the match_index)
+        """
+        codes_1 = self.codes(self.ids_1, match_index, 0)
+        codes_2 = self.codes(self.ids_2, match_index, 1)
+        values = pd.DataFrame(features, match_index).values.astype(self.feature_dtype)
+        self.files[0].write(codes_1.tobytes())
+        self.files[1].write(codes_2.tobytes())
+        self.files[2].write(np.ascontiguousarray(values).tobytes())
+        self.count += len(match_index)
+
+    @staticmethod
+    def codes(ids, match_index, level):
+        # map the (few) level values instead of all id values
+        level_codes = ids.get_indexer(match_index.levels[level])
+        codes = level_codes[match_index.codes[level]]
+        if (codes < 0).any():
+            raise KeyError("match index contains ids, which are not in the lookup table")
+        return codes.astype(np.int32)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        with open(os.path.join(self.dirname, "meta.json"), "w") as meta_file:
+            json.dump(dict(self.meta, columns=self.columns, feature_dtype=self.feature_dtype.name, count=self.count),
+                      meta_file)
+
+
+def read_match_arrays_meta(dirname):
+    """
+    loads the meta data (meta.json) of the matches written by the MatchArrayWriter
+    """
+    with open(os.path.join(dirname, "meta.json")) as meta_file:
+        return json.load(meta_file)
+
+
+def load_match_array(dirname, name, dtype, shape, mmap_mode):
+    """
+    loads an array file of the match arrays (memory mapped, if mmap_mode isn't None)
+    """
+    if shape[0] == 0 or mmap_mode is None:
+        return np.fromfile(os.path.join(dirname, name), dtype=dtype).reshape(shape)
+    return np.memmap(os.path.join(dirname, name), dtype=dtype, mode=mmap_mode, shape=shape)
+
+
+def read_match_array_index(dirname, mmap_mode="r"):
+    """
+    loads only the match index (ids) of the matches written by the MatchArrayWriter, without the features
+    :return: match_index
+    """
+    count = read_match_arrays_meta(dirname)["count"]
+    ids_1 = np.load(os.path.join(dirname, "ids_1.npy"))
+    ids_2 = np.load(os.path.join(dirname, "ids_2.npy"))
+    codes_1 = load_match_array(dirname, "codes_1.bin", np.int32, (count,), mmap_mode)
+    codes_2 = load_match_array(dirname, "codes_2.bin", np.int32, (count,), mmap_mode)
+    return pd.MultiIndex(levels=[ids_1.astype(object), ids_2.astype(object)], codes=[codes_1, codes_2],
+                         names=["id1", "id2"], verify_integrity=False)
+
+
+def read_match_arrays(dirname, mmap_mode="r"):
+    """
+    loads the matches written by the MatchArrayWriter.
+    The codes and features are memory mapped (mmap_mode None loads them into memory)
+    :return: match_index, dataframe of the features
+    """
+    meta = read_match_arrays_meta(dirname)
+    columns = meta["columns"]
+    match_index = read_match_array_index(dirname, mmap_mode)
+    features = load_match_array(dirname, "features.bin", np.dtype(meta["feature_dtype"]),
+                                (meta["count"], len(columns)), mmap_mode)
+    return match_index, pd.DataFrame(features, index=match_index, columns=columns, copy=False)
+
+
 def evaluate_match_index(match_index, perfect_match_index, additional_data=None):
     """
     evaluates the found matches using the perfect_match_index
@@ -29,14 +173,140 @@ def evaluate_match_index(match_index, perfect_match_index, additional_data=None)
     :param additional_data additional data, that will be added to the result
     :return: a dictionary containing "perfect_match_total", "match_correct", "match_incorrect"
     """
+    return MatchEvaluator(perfect_match_index).evaluate(match_index, additional_data)
+
 
-    # pairs classified as matches that are true matches
-    true_positives = (match_index & perfect_match_index).size
-    # pairs classified as matches that are true non-matches
-    false_positives = match_index.size - true_positives
-    # pairs classified as non-matches that are true matches
-    false_negatives = (perfect_match_index.difference(match_index)).size
+class MatchEvaluator:
+    """
+    Evaluates match indexes using the perfect_match_index.
+    The id pairs of the perfect_match_index are converted to integer keys and hashed once,
+    so each evaluation only needs one lookup pass over the match index
+    """
+    def __init__(self, perfect_match_index):
+        self.perfect_match_index = perfect_match_index
+        self.perfect_match_unique = perfect_match_index.unique()
+        self.levels = self.perfect_match_unique.levels
+        self.keys = pd.Index(self.pair_keys(self.perfect_match_unique.codes[0], self.perfect_match_unique.codes[1]))
+        # build the hash table of the keys
+        self.keys.get_indexer(self.keys[:1])
 
+    def pair_keys(self, codes_1, codes_2):
+        """
+        converts the level codes of the id pairs to integer keys
+        """
+        return codes_1.astype(np.int64) * len(self.levels[1]) + codes_2
+
+    def level_codes(self, match_index, level):
+        """
+        returns the codes of the match index values in the levels of the perfect_match_index (-1 = not found)
+        """
+        level_positions = self.levels[level].get_indexer(match_index.levels[level])
+        codes = match_index.codes[level]
+        if len(level_positions) == 0:
+            return np.full(len(codes), -1, dtype=np.int64)
+        return np.where(codes >= 0, level_positions.take(codes), -1)
+
+    def positions(self, match_index):
+        """
+        returns the position of each pair of the match index in perfect_match_unique (-1 = not a perfect match)
+        """
+        codes_1 = self.level_codes(match_index, 0)
+        codes_2 = self.level_codes(match_index, 1)
+        valid = (codes_1 >= 0) & (codes_2 >= 0)
+        result = np.full(len(match_index), -1, dtype=np.int64)
+        result[valid] = self.keys.get_indexer(self.pair_keys(codes_1[valid], codes_2[valid]))
+        return result
+
+    def count_true_positives(self, match_index):
+        """
+        returns the count of distinct pairs of the match index contained in the perfect_match_index
+        """
+        positions = self.positions(match_index)
+        return np.unique(positions[positions >= 0]).size
+
+    def evaluate(self, match_index, additional_data=None):
+        """
+        evaluates the found matches (see evaluate_match_index)
+        """
+        # pairs classified as matches that are true matches
+        true_positives = self.count_true_positives(match_index)
+        # pairs classified as matches that are true non-matches
+        false_positives = match_index.size - true_positives
+        # pairs classified as non-matches that are true matches
+        false_negatives = self.perfect_match_unique.size - true_positives
+
+        return build_result(self.perfect_match_index.size, match_index.size, true_positives, false_positives,
+                            false_negatives, additional_data)
+
+    def evaluate_thresholds(self, match_index, scores, thresholds, additional_data=None, presorted=False):
+        """
+        evaluates the pairs of the match index with a score greater or equal than each threshold.
+        The pairs are sorted by score once and the true positives are counted cumulatively,
+        so all thresholds are evaluated in one pass.
+        :param scores: score of each pair of the match index
+        :param presorted: if True, the pairs are already sorted by descending score and aren't sorted again
+        :return: list of evaluation results (one for each threshold, containing the key "Threshold")
+        """
+        scores = np.asarray(scores)
+        positions = self.positions(match_index)
+        if not presorted:
+            order = np.argsort(-scores, kind="mergesort")
+            scores = scores[order]
+            positions = positions[order]
+        sorted_scores = -scores
+
+        # only the first (highest scored) occurrence of a perfect match is a true positive
+        found_indexes = np.flatnonzero(positions >= 0)
+        first_found = np.zeros(len(positions), dtype=np.int64)
+        first_found[found_indexes[np.unique(positions[found_indexes], return_index=True)[1]]] = 1
+        cumulative_true_positives = np.cumsum(first_found)
+
+        results = []
+        for threshold in thresholds:
+            match_count = int(np.searchsorted(sorted_scores, -threshold, side="right"))
+            true_positives = int(cumulative_true_positives[match_count - 1]) if match_count > 0 else 0
+            add_data = dict(additional_data or {}, Threshold=threshold)
+            results.append(build_result(self.perfect_match_index.size, match_count, true_positives,
+                                        match_count - true_positives,
+                                        self.perfect_match_unique.size - true_positives, add_data))
+        return results
+
+
+class MatchCounter:
+    """
+    Counts the found matches of match index chunks, so the matches
+    don't have to be held in memory for the evaluation
+    """
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.found = np.zeros(evaluator.perfect_match_unique.size, dtype=bool)
+        self.match_count = 0
+
+    def add(self, match_index):
+        """
+        adds the matches of the chunk
+        """
+        positions = self.evaluator.positions(match_index)
+        self.found[positions[positions >= 0]] = True
+        self.match_count += len(match_index)
+
+    def evaluate(self, additional_data=None):
+        """
+        evaluates all added matches (see evaluate_match_index)
+        """
+        true_positives = int(self.found.sum())
+        return build_result(self.evaluator.perfect_match_index.size, self.match_count, true_positives,
+                            self.match_count - true_positives,
+                            self.evaluator.perfect_match_unique.size - true_positives, additional_data)
+
+
+def build_result(perfect_match_count, match_count, true_positives, false_positives, false_negatives,
+                 additional_data=None):
+    """
+    calculates precision, recall and f-measure of the counts and creates the evaluation result
+    :param additional_data additional data, that will be added to the result
+    :return: the evaluation result dictionary
+    """
     # calculate precision and recall
     if true_positives + false_positives != 0:
         precision = round(true_positives / (true_positives + false_positives), 3)
@@ -54,8 +324,8 @@ def evaluate_match_index(match_index, perfect_match_index, additional_data=None)
     result = {
         "Execute Date": datetime.date.today().strftime("%Y-%m-%d"),
         "Execute Time": datetime.datetime.now().time().strftime("%H:%M:%S"),
-        "Perfect Match Count": perfect_match_index.size,
-        "Match Count": match_index.size,
+        "Perfect Match Count": perfect_match_count,
+        "Match Count": match_count,
         "True Positives": true_positives,
         "False Positives": false_positives,
         "False Negatives": false_negatives,
@@ -85,21 +355,102 @@ def print_evaluate_result(result, title=""):
     print("")
 
 
+def results_database_filename(filename):
+    """
+    returns the file name of the results database of the log file (log.csv -> log.sqlite)
+    """
+    return os.path.splitext(filename)[0] + ".sqlite"
+
+
+def quote_column(name):
+    # quotes a column name for sql statements
+    return '"{0}"'.format(str(name).replace('"', '""'))
+
+
+def to_database_value(value):
+    # converts numpy values to python values
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
 def save_results(filename, result):
-    # load file, if existing
-    if os.path.isfile(filename):
-        df = pd.read_csv(filename, sep=";", decimal=",")
-    else:
-        df = pd.DataFrame(columns=list(result.keys()))
+    """
+    appends the result to the results database of the log file (see results_database_filename).
+    The database is locked while the row is added, so concurrent runs can save their results at the same time.
+    Missing columns are added to the database. If the database doesn't exist, the rows of an existing
+    log file are imported first. Use export_results to create the log file
+    """
+    if not result:
+        return
+
+    connection = sqlite3.connect(results_database_filename(filename), timeout=600, isolation_level=None)
+    try:
+        # lock the database for writing
+        connection.execute("BEGIN IMMEDIATE")
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(results)")]
+        if not columns:
+            connection.execute("CREATE TABLE results (row_id INTEGER PRIMARY KEY AUTOINCREMENT)")
+            columns = ["row_id"]
+            if os.path.isfile(filename):
+                # import the rows of the existing log file
+                df = pd.read_csv(filename, sep=";", decimal=",")
+                for row in df.to_dict(orient="records"):
+                    columns = insert_result(connection, columns, {key: value for key, value in row.items()
+                                                                  if not pd.isnull(value)})
+
+        insert_result(connection, columns, result)
+        connection.execute("COMMIT")
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
 
-    # add missing columns
+def insert_result(connection, columns, result):
+    """
+    inserts the result as row of the results table and adds the missing columns
+    :return: the columns of the table
+    """
     for key in result.keys():
-        if key not in df.columns:
-            df[key] = None
+        if key not in columns:
+            connection.execute("ALTER TABLE results ADD COLUMN {0}".format(quote_column(key)))
+            columns = columns + [key]
+
+    keys = list(result.keys())
+    connection.execute("INSERT INTO results ({0}) VALUES ({1})".format(",".join(map(quote_column, keys)),
+                                                                      ",".join("?" * len(keys))),
+                       [to_database_value(result[key]) for key in keys])
+    return columns
 
-    # add the row
-    df = df.append(result, ignore_index=True)
 
-    # save
-    df.to_csv(filename, index=False, sep=";", decimal=",")
+def load_results(filename):
+    """
+    loads all results of the results database of the log file as dataframe (in the order they were saved)
+    """
+    database_filename = results_database_filename(filename)
+    if not os.path.isfile(database_filename):
+        return pd.DataFrame()
+
+    connection = sqlite3.connect(database_filename, timeout=600)
+    try:
+        df = pd.read_sql_query("SELECT * FROM results ORDER BY row_id", connection)
+    finally:
+        connection.close()
+    return df.drop(columns=["row_id"])
+
+
+def export_results(filename):
+    """
+    exports the results database as log file (semicolon separated, decimal comma)
+    """
+    df = load_results(filename)
+    if df.empty:
+        return
 
+    # write to a temporary file first, so the log file is always complete
+    temp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+    df.to_csv(temp_filename, index=False, sep=";", decimal=",")
+    os.replace(temp_filename, filename)
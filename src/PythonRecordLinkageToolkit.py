@@ -1,6 +1,6 @@
 import recordlinkage as rl
 import pandas as pd
-import random as rnd
+import multiprocessing
 from datetime import datetime
 import Evaluation as ev
 import Tools as tools
@@ -16,19 +16,58 @@ class Config_Item:
         self.sorted_neighborhood_window = json_item.get("sorted_neighborhood_window", 9)
         self.canopy_threshold_add = json_item.get("canopy_threshold_add", 0.5)
         self.canopy_threshold_remove = json_item.get("canopy_threshold_remove", 0.7)
+        self.canopy_engine = json_item.get("canopy_engine", "sparse")
+        self.canopy_n_jobs = json_item.get("canopy_n_jobs", 1)
+        self.canopy_parallel_mode = json_item.get("canopy_parallel_mode", "deterministic")
+        self.minhash_bands = json_item.get("minhash_bands", 30)
+        self.minhash_rows = json_item.get("minhash_rows", 3)
+        self.minhash_shingles = json_item.get("minhash_shingles", "bigram")
+        self.minhash_seed = json_item.get("minhash_seed", tools.RANDOM_SEED)
         self.index_field_name = json_item.get("index_field_name", "")
         self.index_type = json_item.get("index_type", "sorted_neighbourhood")
+        # index settings of the indexers of the index_type union
+        self.indexes = [Config_Item(json_index) for json_index in json_item.get("indexes", [])]
+        self.golden_pairs_sampling = json_item.get("golden_pairs_sampling", "compatible")
+        self.compare_chunk_size = json_item.get("compare_chunk_size", 0)
         self.classifier_types = [x.lower() for x in json_item.get("classifier_types", ["svm"])]
         if isinstance(self.classifier_types, str):
             self.classifier_types = [self.classifier_types]
 
+    def index_key(self):
+        """
+        returns a key containing the index settings used by the index_type
+        """
+        if self.index_type == "sorted_neighbourhood":
+            settings = (self.sorted_neighborhood_window,)
+        elif self.index_type == "canopy":
+            settings = (self.canopy_threshold_add, self.canopy_threshold_remove, self.canopy_engine,
+                        self.canopy_n_jobs, self.canopy_parallel_mode)
+        elif self.index_type == "minhash_lsh":
+            settings = (self.minhash_bands, self.minhash_rows, self.minhash_shingles, self.minhash_seed)
+        elif self.index_type == "union":
+            settings = tuple(index.index_key() for index in self.indexes)
+        else:
+            settings = ()
+        return (self.index_type, self.index_field_name) + settings
+
     def to_dict(self):
         return {"golden_pairs_count": self.golden_pairs_count,
+                "golden_pairs_sampling": self.golden_pairs_sampling,
                 "index_type": self.index_type,
                 "index_field_name": self.index_field_name,
+                "indexes": "+".join("{0}({1})".format(index.index_type, index.index_field_name)
+                                    for index in self.indexes),
                 "canopy_threshold_add": self.canopy_threshold_add,
                 "canopy_threshold_remove": self.canopy_threshold_remove,
-                "sorted_neighborhood_window": self.sorted_neighborhood_window}
+                "canopy_engine": self.canopy_engine,
+                "canopy_n_jobs": self.canopy_n_jobs,
+                "canopy_parallel_mode": self.canopy_parallel_mode,
+                "minhash_bands": self.minhash_bands,
+                "minhash_rows": self.minhash_rows,
+                "minhash_shingles": self.minhash_shingles,
+                "minhash_seed": self.minhash_seed,
+                "sorted_neighborhood_window": self.sorted_neighborhood_window,
+                "compare_chunk_size": self.compare_chunk_size}
 
 
 def classifier_abbreviation(classifier):
@@ -69,146 +108,481 @@ def create_and_train_logistic_regression():
     return train_supervised_classifier(rl.LogisticRegressionClassifier())
 
 
-def create_and_train_kmeans():
+def create_and_train_kmeans(training_features):
     """
     Creates and trains a KMeans Classifier
     """
     classifier = rl.KMeansClassifier()
-    classifier.learn(features)
+    classifier.learn(training_features)
     return classifier
 
 
+def create_and_train_classifier(config_index, classifier_number, kmeans_features):
+    """
+    Creates and trains a classifier of the config item.
+    Each classifier gets its own seed, so the result doesn't depend on the execution order
+    :return: classifier, filename_key
+    """
+    config_item = config.items[config_index]
+    classifier = config_item.classifier_types[classifier_number]
+    tools.init_random_with_seed((config_index + 1) * 1000 + classifier_number + 1)
+
+    if classifier == "svm":
+        return create_and_train_svm(), "svm"
+    elif classifier == "kmeans":
+        return create_and_train_kmeans(kmeans_features), "km"
+    elif classifier == "naive_bayes":
+        return create_and_train_naive_bayes(), "nb"
+    elif classifier == "logistic_regression":
+        return create_and_train_logistic_regression(), "lr"
+    else:
+        raise ValueError("classifier_types {0} is invalid: must be kmeans, svm, naive_bayes or logistic_regression".format(
+            config_item.classifier_types))
+
+
 def predict_and_save(classifier, filename_key, current_config_item, config_index):
     """
     Uses the trained classifier to classify the features and save them as file
     using the result_file_template by adding the filename_key
+    :return: the evaluation result
     """
     # predict the matches
     result_index = classifier.predict(features)
 
     # save the file
-    result_filename = config.common.get_result_file_name(config_index, "result_{}.csv".format(filename_key))
-    pd.DataFrame(features, result_index).to_csv(result_filename)
+    match_writer = create_match_writer(config_index, filename_key, features.columns)
+    match_writer.append(result_index, features)
+    match_writer.close()
 
     # call the evaluation on the created matches
+    add_data = create_additional_data(classifier, current_config_item, config_index,
+                                      pairs_index.size, evaluator.count_true_positives(pairs_index))
+    return evaluator.evaluate(result_index, add_data)
+
+
+def create_match_writer(config_index, filename_key, columns):
+    """
+    Creates the writer of the result file using the result_format of the config
+    (csv: result_<filename_key>.csv, arrays: directory result_<filename_key> containing NumPy arrays)
+    """
+    if config.common.result_format == "csv":
+        return ev.MatchCsvWriter(config.common.get_result_file_name(config_index, "result_{}.csv".format(filename_key)))
+    elif config.common.result_format == "arrays":
+        return ev.MatchArrayWriter(config.common.get_result_file_name(config_index, "result_{}".format(filename_key)),
+                                   dfFile1.index.unique(), dfFile2.index.unique(), columns,
+                                   config.common.feature_dtype)
+    else:
+        raise ValueError("result_format {0} is invalid: must be csv or arrays".format(config.common.result_format))
+
+
+def create_additional_data(classifier, current_config_item, config_index, indexed_pairs,
+                           indexed_pairs_perfect_match):
+    """
+    Creates the data of the config item and the classifier added to the evaluation result
+    :param indexed_pairs: count of the indexed pairs
+    :param indexed_pairs_perfect_match: count of the perfect matches contained in the indexed pairs
+    """
     add_data = current_config_item.to_dict()
     add_data["config_name"] = config.common.config_name
     add_data["config_item_index"] = config_index
     add_data["fields"] = config.common.fields_to_string()
     add_data["classifier"] = type(classifier).__name__
     add_data["classifier_abbreviation"] = classifier_abbreviation(classifier)
-    add_data["Indexed_pairs"] = pairs_index.size
-    add_data["Indexed_pairs_perfect_match"] = pairs_index.intersection(perfect_match_index).size
+    add_data["Indexed_pairs"] = indexed_pairs
+    add_data["Indexed_pairs_perfect_match"] = indexed_pairs_perfect_match
+    add_data.update(index_statistics)
+    return add_data
 
-    result_eval = ev.evaluate_match_index(result_index, perfect_match_index, add_data)
-    ev.print_evaluate_result(result_eval)
 
-    ev.save_results(config.common.result_base_dir + "log.csv", result_eval)
+def create_golden_pairs(pairs, max_count, seed_compatible):
+    """
+    Creates a sample of the pairs containing max_count matches and
+    max_count distincts.
+    If seed_compatible is set, the sample is identical to the former list based sampling
+    :return: golden_pair_index, golden_pair_matches_index
+    """
+    assert (max_count < perfect_match_index.size), "golden_pairs_count is greater then the count of golden pairs"
+
+    if seed_compatible:
+        # create full match and distinct index (in the order used by the former sampling)
+        full_index_match = pairs.intersection(perfect_match_index)
+        full_index_distinct = pairs.difference(perfect_match_index)
 
+        train_match = tools.sample_index(full_index_match, max_count, True)
+        train_distinct = tools.sample_index(full_index_distinct, max_count, True)
 
-def create_list_of_random_elements(index, max_count):
+        res_pairs = pd.MultiIndex.from_tuples(list(set().union(train_match, train_distinct)))
+        res_match = pd.MultiIndex.from_tuples(list(train_match))
+        return res_pairs, res_match
+
+    # sample the positions of the matches and distincts in the pairs
+    is_match = evaluator.positions(pairs) >= 0
+    train_match = tools.sample_index(pairs[is_match], max_count)
+    train_distinct = tools.sample_index(pairs[~is_match], max_count)
+
+    return train_match.append(train_distinct), train_match
+
+
+def create_golden_pairs_full(full_index, max_count):
     """
-    extract max_count items from the index and returns them as list
+    Creates a sample of the full index containing max_count matches and max_count distincts
+    without creating the full index. The distincts are drawn using tools.sample_pairs
+    :return: golden_pair_index, golden_pair_matches_index
     """
+    perfect_match_unique = perfect_match_index.unique()
+    full_index_match = perfect_match_unique[full_index.contains(dfFile1, dfFile2, perfect_match_unique)]
+    assert (max_count < full_index_match.size), "golden_pairs_count is greater then the count of golden pairs"
 
-    if isinstance(index, pd.core.index.MultiIndex):
-        # if index is a MultiIndex, convert it to list
-        elements = index.tolist()
-    else:
-        # otherwise create a copy of the list
-        elements = list(index)
-    result = list()
+    train_match = tools.sample_index(full_index_match, max_count)
+    train_distinct = tools.sample_pairs(dfFile1.index, dfFile2.index, max_count, exclude_index=perfect_match_index)
+    return train_match.append(train_distinct), train_match
+
+
+def load_data():
+    """
+    Loads the configuration and the data files into the global variables.
+    Called by the main process and by each worker process of the sweep
+    """
+    global config, dfFile1, dfFile2, perfect_match_index, evaluator, feature_cache
 
-    while len(result) < max_count and elements:
-        key = rnd.choice(elements)
-        result.append(key)
-        elements.remove(key)
+    # init the configuration
+    config = tools.get_config(Config_Item)
+    feature_cache = tools.LRUCache(config.common.feature_cache_size)
+
+    fieldnames = []
+    for cfg in config.common.fields:
+        fieldnames.append(cfg.name)
 
-    return result
+    dfFile1 = tools.load_file_as_df(config.common.filename_1, fieldnames)
+    dfFile2 = tools.load_file_as_df(config.common.filename_2, fieldnames)
+    perfect_match_index = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
+    evaluator = ev.MatchEvaluator(perfect_match_index)
 
 
-def create_golden_pairs(max_count):
+def create_indexer(config_item):
     """
-    Creates a sample of the features containing max_count matches and
-    max_count distincts
-    :return: golden_pair_df, golden_pair_matches_index
+    Creates the indexer of the config item
     """
-    assert (max_count < perfect_match_index.size), "golden_pairs_count is greater then the count of golden pairs"
+    if config_item.index_type == "sorted_neighbourhood":
+        return rl.SortedNeighbourhoodIndex(config_item.index_field_name,
+                                           window=config_item.sorted_neighborhood_window)
+    elif config_item.index_type == "block":
+        return rl.BlockIndex(config_item.index_field_name)
+    elif config_item.index_type == "canopy":
+        # a worker process of the process pool can't start the canopy process pool (daemonic processes
+        # are not allowed to have children), so the canopy runs sequentially in a worker
+        canopy_n_jobs = 1 if multiprocessing.current_process().daemon else config_item.canopy_n_jobs
+        return tools.CanopyClusterIndex(config_item.index_field_name,
+                                        threshold_add=config_item.canopy_threshold_add,
+                                        threshold_remove=config_item.canopy_threshold_remove,
+                                        engine=config_item.canopy_engine,
+                                        n_jobs=canopy_n_jobs,
+                                        parallel_mode=config_item.canopy_parallel_mode)
+    elif config_item.index_type == "minhash_lsh":
+        return tools.MinHashLSHIndex(config_item.index_field_name,
+                                     bands=config_item.minhash_bands,
+                                     rows=config_item.minhash_rows,
+                                     shingles=config_item.minhash_shingles,
+                                     seed=config_item.minhash_seed)
+    elif config_item.index_type == "full":
+        return tools.FullIndex()
+    elif config_item.index_type == "union":
+        if not config_item.indexes:
+            raise ValueError("index_type union needs the indexes of the union")
+        return tools.UnionIndex([create_indexer(index) for index in config_item.indexes])
+    else:
+        raise ValueError("index_type {0} is invalid: must be sorted_neighbourhood, block, canopy, minhash_lsh, full or union".format(config_item.index_type))
 
-    # create full match and distinct list
-    full_index_match = features.index.intersection(perfect_match_index)
-    full_index_distinct = features.index.difference(perfect_match_index)
 
-    train_match = create_list_of_random_elements(full_index_match, max_count)
-    train_distinct = create_list_of_random_elements(full_index_distinct, max_count)
+# index of the config item, that was prepared by prepare_config_item
+prepared_config_index = None
 
-    res_pairs = pd.DataFrame(features, pd.MultiIndex.from_tuples(list(set().union(train_match, train_distinct))))
-    res_match = pd.MultiIndex.from_tuples(list(train_match))
-    return res_pairs, res_match
+# pairs_index, index_statistics and features of the recently used index settings (created by load_data)
+feature_cache = None
 
+# pairs_index, index_statistics and features (None, if only used by chunked config items) of each feature key,
+# created by the main process before the process pool is started (see init_worker)
+shared_features = {}
 
-# ------------------ Main ---------------
 
-start_time = datetime.now()
+def init_worker(main_shared_features):
+    """
+    Initializes a worker process of the process pool with the pairs and features created by the main process
+    """
+    global shared_features
+    load_data()
+    shared_features = main_shared_features
 
-# init the configuration
-config = tools.get_config(Config_Item)
 
-print("Load Files")
-fieldnames = []
-for cfg in config.common.fields:
-    fieldnames.append(cfg.name)
+def get_feature_key(config_item):
+    # config items with the same index settings and fields share the pairs_index and features
+    return config_item.index_key() + (config.common.fields_to_string(),)
 
-dfFile1 = tools.load_file_as_df(config.common.filename_1, fieldnames)
-dfFile2 = tools.load_file_as_df(config.common.filename_2, fieldnames)
-perfect_match_index = tools.load_perfect_match_as_index(config.common.filename_perfect_match)
 
-# for each config item
-for index, config_item in enumerate(config.items):
-    # init Random with a fixes seed (for reproducibility)
-    tools.init_random_with_seed()
+def find_pairs_index(config_item):
+    """
+    Searches the pairs_index of the index settings of the config item in the shared features,
+    the features entry and the pairs entry of the feature cache
+    :return: pairs_index, index_statistics or None, if the pairs aren't created yet
+    """
+    feature_key = get_feature_key(config_item)
+    if feature_key in shared_features:
+        return shared_features[feature_key][:2]
+    for key in (feature_key, config_item.index_key() + ("pairs",)):
+        if key in feature_cache:
+            print("Reusing pairs of {0}".format(key))
+            return feature_cache.get(key, None)[:2]
+    return None
 
+
+def create_pairs_index(config_item):
+    """
+    Creates the pairs_index of the config item
+    :return: pairs_index, index_statistics (pair counts of the indexers of the index_type union)
+    """
     print("Indexing")
-    if config_item.index_type == "sorted_neighbourhood":
-        indexer = rl.SortedNeighbourhoodIndex(config_item.index_field_name,
-                                              window=config_item.sorted_neighborhood_window)
-    elif config_item.index_type == "block":
-        indexer = rl.BlockIndex(config_item.index_field_name)
-    elif config_item.index_type == "canopy":
-        indexer = tools.CanopyClusterIndex(config_item.index_field_name,
-                                           threshold_add=config_item.canopy_threshold_add,
-                                           threshold_remove=config_item.canopy_threshold_remove)
-    elif config_item.index_type == "full":
-        indexer = tools.FullIndex(config_item.index_field_name)
-    else:
-        raise ValueError("index_type {0} is invalid: must be sorted_neighbourhood, block, canopy or full".format(config_item.index_type))
+    indexer = create_indexer(config_item)
+    new_pairs_index = indexer.index(dfFile1, dfFile2)
+
+    new_index_statistics = getattr(indexer, "statistics", {})
+    for key, value in new_index_statistics.items():
+        print("{0}: {1}".format(key, value))
+    return new_pairs_index, new_index_statistics
+
+
+def create_pairs_and_features(config_item):
+    """
+    Creates the pairs_index and the compared features of the config item
+    :return: pairs_index, index_statistics, features
+    """
+    new_pairs_index, new_index_statistics = find_pairs_index(config_item) or create_pairs_index(config_item)
+
+    print("Comparing {0} Pairs".format(new_pairs_index.size))
+    return new_pairs_index, new_index_statistics, compute_features(create_compare(), new_pairs_index)
+
+
+def compute_features(compare_cl, index):
+    """
+    Computes the features of the pairs of the index using the feature_dtype of the config
+    """
+    return compare_cl.compute(index, dfFile1, dfFile2).astype(config.common.feature_dtype, copy=False)
 
-    pairs_index = indexer.index(dfFile1, dfFile2)
 
-    print("Comparing {0} Pairs".format(pairs_index.size))
+def create_compare():
+    """
+    Creates the compare class of the configured fields
+    """
     compare_cl = rl.Compare()
     for cfg in config.common.fields:
         compare_cl.string(s1=cfg.name, s2=cfg.name, method=cfg.type)
-    features = compare_cl.compute(pairs_index, dfFile1, dfFile2)
+    return compare_cl
+
+
+def check_golden_pairs_sampling(config_item):
+    if config_item.golden_pairs_sampling not in ("compatible", "numpy"):
+        raise ValueError("golden_pairs_sampling {0} is invalid: must be compatible or numpy".format(
+            config_item.golden_pairs_sampling))
+
+
+def prepare_config_item(config_index):
+    """
+    Creates the pairs_index, the features and the training data of the config item.
+    The prepared config item is reused, if it's prepared again
+    """
+    global prepared_config_index, pairs_index, index_statistics, features, golden_pairs, golden_matches_index
+
+    if prepared_config_index == config_index:
+        return
+    config_item = config.items[config_index]
+
+    # init Random with a fixes seed (for reproducibility)
+    tools.init_random_with_seed()
+
+    feature_key = get_feature_key(config_item)
+    if shared_features.get(feature_key, (None, None, None))[2] is not None:
+        pairs_index, index_statistics, features = shared_features[feature_key]
+    else:
+        if feature_key in feature_cache:
+            print("Reusing pairs and features of {0}".format(feature_key))
+        pairs_index, index_statistics, features = feature_cache.get(feature_key,
+                                                                    lambda: create_pairs_and_features(config_item))
 
     print("Creating training data")
-    golden_pairs, golden_matches_index = create_golden_pairs(config_item.golden_pairs_count)
-    # classification
-
-    print("Classification")
-    print("")
-
-    for classifier in config_item.classifier_types:
-        if classifier == "svm":
-            predict_and_save(create_and_train_svm(), "svm", config_item, index)
-        elif classifier == "kmeans":
-            predict_and_save(create_and_train_kmeans(), "km", config_item, index)
-        elif classifier == "naive_bayes":
-            predict_and_save(create_and_train_naive_bayes(), "nb", config_item, index)
-        elif classifier == "logistic_regression":
-            predict_and_save(create_and_train_logistic_regression(), "lr", config_item, index)
+    check_golden_pairs_sampling(config_item)
+    golden_index, golden_matches_index = create_golden_pairs(features.index, config_item.golden_pairs_count,
+                                                             config_item.golden_pairs_sampling == "compatible")
+    golden_pairs = pd.DataFrame(features, golden_index)
+    prepared_config_index = config_index
+
+
+def run_classifier(config_index, classifier_number):
+    """
+    Trains and evaluates a classifier of a config item
+    :param classifier_number: the number of the classifier in the classifier_types of the config item
+    :return: the evaluation result
+    """
+    config_item = config.items[config_index]
+    prepare_config_item(config_index)
+
+    classifier, filename_key = create_and_train_classifier(config_index, classifier_number, features)
+    return predict_and_save(classifier, filename_key, config_item, config_index)
+
+
+def run_classifiers_chunked(config_index, classifier_numbers):
+    """
+    Trains the classifiers of the config item and classifies the pairs in chunks of compare_chunk_size pairs.
+    Only the features of one chunk are held in memory, the matches are appended to the result files
+    and counted for the evaluation after each chunk.
+    The supervised classifiers are trained like in run_classifier. KMeans is trained using the features
+    of compare_chunk_size random pairs (instead of all pairs).
+    The full index is created lazily in blocks of compare_chunk_size pairs, its golden pairs are sampled
+    without creating the full index (independent of golden_pairs_sampling)
+    :return: list of evaluation results
+    """
+    global pairs_index, index_statistics, golden_pairs, golden_matches_index, prepared_config_index
+
+    config_item = config.items[config_index]
+    chunk_size = config_item.compare_chunk_size
+
+    # init Random with a fixes seed (for reproducibility)
+    tools.init_random_with_seed()
+
+    compare_cl = create_compare()
+    check_golden_pairs_sampling(config_item)
+    if config_item.index_type == "full":
+        pairs_index = None
+        index_statistics = {}
+        full_index = tools.FullIndex(block_size=chunk_size)
+        indexed_pairs = full_index.pair_count(dfFile1, dfFile2)
+        indexed_pairs_perfect_match = evaluator.count_true_positives(
+            perfect_match_index[full_index.contains(dfFile1, dfFile2, perfect_match_index)])
+
+        print("Creating training data")
+        golden_index, golden_matches_index = create_golden_pairs_full(full_index, config_item.golden_pairs_count)
+        pairs_chunks = full_index.index_blocks(dfFile1, dfFile2)
+    else:
+        pairs_index, index_statistics = find_pairs_index(config_item) or feature_cache.get(
+            config_item.index_key() + ("pairs",), lambda: create_pairs_index(config_item))
+        indexed_pairs = pairs_index.size
+        indexed_pairs_perfect_match = evaluator.count_true_positives(pairs_index)
+
+        print("Creating training data")
+        golden_index, golden_matches_index = create_golden_pairs(pairs_index, config_item.golden_pairs_count,
+                                                                 config_item.golden_pairs_sampling == "compatible")
+        pairs_chunks = (pairs_index[start:start + chunk_size] for start in range(0, len(pairs_index), chunk_size))
+
+    golden_pairs = compute_features(compare_cl, golden_index)
+    kmeans_features = None
+    if "kmeans" in [config_item.classifier_types[number] for number in classifier_numbers]:
+        if pairs_index is None:
+            kmeans_index = tools.sample_pairs(dfFile1.index, dfFile2.index, min(chunk_size, indexed_pairs))
         else:
-            raise ValueError("classifier_types {0} is invalid: must be kmeans, svm, naive_bayes or logistic_regression".format(
-                config_item.classifier_types))
+            kmeans_index = tools.sample_index(pairs_index, chunk_size)
+        kmeans_features = compute_features(compare_cl, kmeans_index)
+    # the training data of the global variables doesn't belong to the prepared config item anymore
+    prepared_config_index = None
+
+    classifiers = []
+    for classifier_number in classifier_numbers:
+        classifier, filename_key = create_and_train_classifier(config_index, classifier_number, kmeans_features)
+        match_writer = create_match_writer(config_index, filename_key, golden_pairs.columns)
+        classifiers.append((classifier, match_writer, ev.MatchCounter(evaluator)))
+
+    print("Comparing {0} Pairs in chunks of {1} pairs".format(indexed_pairs, chunk_size))
+    for chunk_index in pairs_chunks:
+        chunk_features = compute_features(compare_cl, chunk_index)
+        for classifier, match_writer, match_counter in classifiers:
+            chunk_result_index = classifier.predict(chunk_features)
+            match_writer.append(chunk_result_index, chunk_features)
+            match_counter.add(chunk_result_index)
+
+    results = []
+    for classifier, match_writer, match_counter in classifiers:
+        match_writer.close()
+        add_data = create_additional_data(classifier, config_item, config_index, indexed_pairs,
+                                          indexed_pairs_perfect_match)
+        results.append(match_counter.evaluate(add_data))
+    return results
+
+
+def create_tasks():
+    """
+    Creates the tasks of the config items in the order of the config items. Each classifier of a config item
+    is a task, the classifiers of a chunked config item are one task (they classify the same chunks)
+    :return: list of tasks (config_index, classifier_numbers)
+    """
+    tasks = []
+    for config_index, config_item in enumerate(config.items):
+        classifier_numbers = list(range(len(config_item.classifier_types)))
+        if config_item.compare_chunk_size > 0:
+            tasks.append((config_index, classifier_numbers))
+        else:
+            tasks.extend((config_index, [classifier_number]) for classifier_number in classifier_numbers)
+    return tasks
+
+
+def create_shared_features():
+    """
+    Creates the pairs and features of each feature key once (the pairs only, if the feature key is only
+    used by chunked config items), so the worker processes don't index and compare the same pairs
+    """
+    for config_item in config.items:
+        feature_key = get_feature_key(config_item)
+        if config_item.compare_chunk_size == 0:
+            if shared_features.get(feature_key, (None, None, None))[2] is None:
+                tools.init_random_with_seed()
+                shared_features[feature_key] = create_pairs_and_features(config_item)
+        elif config_item.index_type != "full" and feature_key not in shared_features:
+            tools.init_random_with_seed()
+            shared_features[feature_key] = create_pairs_index(config_item) + (None,)
+
+
+def run_task(task):
+    """
+    Runs the classifiers of a config item
+    :param task: config_index, classifier_numbers
+    :return: list of evaluation results
+    """
+    config_index, classifier_numbers = task
+    if config.items[config_index].compare_chunk_size > 0:
+        return run_classifiers_chunked(config_index, classifier_numbers)
+    return [run_classifier(config_index, classifier_number) for classifier_number in classifier_numbers]
 
-print('Time elapsed (hh:mm:ss.ms) {}'.format(datetime.now() - start_time))
+
+def save_result(result_eval):
+    """
+    Prints the evaluation result and adds it to the log file.
+    Only called by the main process, so the workers never write the log file
+    """
+    ev.print_evaluate_result(result_eval)
+    ev.save_results(config.common.result_base_dir + "log.csv", result_eval)
+
+
+# ------------------ Main ---------------
+
+if __name__ == "__main__":
+    start_time = datetime.now()
+
+    print("Load Files")
+    load_data()
+
+    tasks = create_tasks()
+
+    if config.common.n_jobs > 1:
+        # the pairs and features are created by the main process and passed to the workers
+        create_shared_features()
+
+        # run the tasks in a process pool. The results are returned in the order of the tasks
+        with multiprocessing.Pool(config.common.n_jobs, init_worker, (shared_features,)) as pool:
+            for results in pool.imap(run_task, tasks):
+                for result in results:
+                    save_result(result)
+    else:
+        print("Classification")
+        print("")
+        for task in tasks:
+            for result in run_task(task):
+                save_result(result)
+
+    ev.export_results(config.common.result_base_dir + "log.csv")
+    print('Time elapsed (hh:mm:ss.ms) {}'.format(datetime.now() - start_time))
@@ -6,8 +6,16 @@ import json
 import sys
 import random as rnd
 import math
+import hashlib
+import pickle
+import multiprocessing
+import bisect
+import zlib
+import numpy as np
+from scipy import sparse
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
 from recordlinkage.base import BaseIndexator
 
 class Config:
@@ -33,6 +41,13 @@ class Config_Common:
         self.filename_2 = self.base_dir + json_common["filename_2"]
         self.filename_perfect_match = self.base_dir + json_common["filename_perfect_match"]
         self.result_base_dir = json_common["result_base_dir"]
+        self.n_jobs = json_common.get("n_jobs", 1)
+        self.feature_cache_size = json_common.get("feature_cache_size", 2)
+        self.store_values = json_common.get("store_values", True)
+        self.single_bin_file = json_common.get("single_bin_file", False)
+        self.model_cache = json_common.get("model_cache", True)
+        self.feature_dtype = json_common.get("feature_dtype", "float64")
+        self.result_format = json_common.get("result_format", "csv")
         self.fields = []
 
         for json_common_field in json_common["fields"]:
@@ -93,6 +108,45 @@ def pre_process_string(value):
     return value
 
 
+# translation table and pattern used by pre_process_series.
+# the table combines the single character replacements of pre_process_string,
+# which are independent of each other and can be applied in one pass
+PRE_PROCESS_TRANSLATION = str.maketrans({"\n": " ", "-": None, "/": " ", "'": None, ",": None, ":": " "})
+PRE_PROCESS_MULTIPLE_SPACES = re.compile("  +")
+
+
+def pre_process_value(value):
+    """
+    Cleans a single value like pre_process_string, but uses the
+    precompiled translation table and pattern
+    """
+    if type(value) in (float, int):
+        return None
+
+    value = unidecode(value).translate(PRE_PROCESS_TRANSLATION)
+    value = PRE_PROCESS_MULTIPLE_SPACES.sub(" ", value)
+    value = value.strip().strip('"').strip("'").lower().strip()
+    if not value:
+        value = None
+    return value
+
+
+def pre_process_series(series):
+    """
+    Cleans all values of the series. The result is identical to calling
+    pre_process_string for each value, but each distinct value is only processed once
+    """
+    codes, uniques = pd.factorize(series.astype(object))
+
+    # process the distinct values (the last element is used for missing values)
+    processed = np.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        processed[i] = pre_process_value(value)
+    processed[-1] = None
+
+    return pd.Series(processed.take(codes), index=series.index, name=series.name, dtype=object)
+
+
 def load_perfect_match_as_index(filename):
     """
     Creates a MultiIndex based on the perfect mapping file
@@ -101,30 +155,105 @@ def load_perfect_match_as_index(filename):
     """
     # loading perfectMapping File
     pm = pd.read_csv(filename, encoding="iso-8859-1", engine='c', skipinitialspace=True)
-    # create a list of tuples
-    idx_tuples = []
-    for index, row in pm.iterrows():
-        idx_tuples.append((str(row[0]), str(row[1])))
-    # return as multiIndex
-    return pd.MultiIndex.from_tuples(idx_tuples, names=["id1", "id2"])
+    # return the id columns (converted to string) as multiIndex
+    return pd.MultiIndex.from_arrays([pm.iloc[:, 0].astype(str).values, pm.iloc[:, 1].astype(str).values],
+                                     names=["id1", "id2"])
 
 
-def load_file_as_df(filename, preprocessing_fieldnames):
+def load_file_as_df(filename, preprocessing_fieldnames, use_cache=True):
     """
     Loads a Data File. It is expected, that the file contains the following columns:
     unique_id (the identifier column), title, description
+    If use_cache is set, the preprocessed data is loaded from / saved to the data cache
     """
+    if use_cache:
+        cache_filename = get_cache_filename(filename, "df", preprocessing_fieldnames)
+        data = load_cache(cache_filename)
+        if data is not None:
+            return data
+
     data = pd.read_csv(filename, encoding="iso-8859-1", engine='c', skipinitialspace=True, index_col=[0])
     # call the preprocessing method on the 2 columns title and description
 
     data.index = data.index.map(str)
     if preprocessing_fieldnames:
         for fieldname in preprocessing_fieldnames:
-            data[fieldname] = data[fieldname].apply(lambda x: pre_process_string(x))
+            data[fieldname] = pre_process_series(data[fieldname])
+
+    if use_cache:
+        save_cache(cache_filename, data)
 
     return data
 
 
+# version of the cached data. Must be increased, if the loading or preprocessing changes
+CACHE_VERSION = 1
+
+
+# hashes of the hashed files by (path, modification time, size), so a file is hashed once per run
+file_hashes = {}
+
+
+def hash_file(filename):
+    """
+    returns the sha1 hash of the file content
+    """
+    stat = os.stat(filename)
+    file_key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    if file_key in file_hashes:
+        return file_hashes[file_key]
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+    file_hashes[file_key] = sha.hexdigest()
+    return file_hashes[file_key]
+
+
+def get_cache_filename(filename, kind, preprocessing_fieldnames, related_filenames=None):
+    """
+    returns the name of the cache file for the data file. The cache files are stored in the
+    cache subdirectory of the data file. The name contains a hash of the file content,
+    the kind of the loaded data and the preprocessed fields, so a changed data file
+    automatically results in a new cache file. The Python and pandas versions are part of the key,
+    because the pickled data of other versions may not be loadable.
+    The content of the related_filenames is added to the hash (for data based on multiple files)
+    """
+    key = "{0}|{1}|{2}|{3}|{4}|{5}".format(CACHE_VERSION, sys.version_info[:2], pd.__version__, kind,
+                                           hash_file(filename), ",".join(sorted(set(preprocessing_fieldnames or []))))
+    for related_filename in related_filenames or []:
+        key += "|" + hash_file(related_filename)
+    key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(os.path.dirname(filename), "cache", "{0}_{1}.pkl".format(Path(filename).stem, key_hash))
+
+
+def load_cache(cache_filename):
+    """
+    loads the cached data. returns None, if the cache file doesn't exist or is invalid
+    (e.g. pickled by other versions of the libraries), so the data is created again
+    """
+    if not os.path.isfile(cache_filename):
+        return None
+    try:
+        with open(cache_filename, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError, ValueError):
+        return None
+
+
+def save_cache(cache_filename, data):
+    """
+    saves the data to the cache file. The data is written to a temporary file first,
+    so concurrent runs never read a partly written cache file
+    """
+    ensure_directories(cache_filename)
+    temp_filename = "{0}.{1}.tmp".format(cache_filename, os.getpid())
+    with open(temp_filename, 'wb') as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, cache_filename)
+
+
 def ensure_directories(filename):
     """
     creates the directories used in the filename, if they don't exist
@@ -170,11 +299,89 @@ def get_config(config_item_class):
 
     return result
 
-def init_random_with_seed():
+# seed of the random generators
+RANDOM_SEED = 34758139
+
+
+def init_random_with_seed(offset=0):
+    """
+    initializes the random generators with a fixed seed.
+    The offset is added to the seed to derive a different seed (e.g. for a task of a process pool)
+    """
+    rnd.seed(RANDOM_SEED + offset)
+    np.random.seed((RANDOM_SEED + offset) % 2 ** 32)
+
+
+def sample_positions(count, max_count, seed_compatible=False):
+    """
+    draws max_count distinct random positions out of 0..count-1 (without replacement).
+    If seed_compatible is set, the positions are drawn with the random generator and are identical
+    to drawing elements with rnd.choice and removing them from the list of elements.
+    Otherwise a numpy generator seeded by the random generator is used
+    """
+    max_count = min(max_count, count)
+    if not seed_compatible:
+        generator = np.random.default_rng(rnd.getrandbits(64))
+        return generator.choice(count, max_count, replace=False)
+
+    # removed positions (sorted)
+    removed = []
+    result = np.empty(max_count, dtype=np.int64)
+    for i in range(max_count):
+        # draw the position in the list of remaining elements and map it to the original position
+        position = rnd.choice(range(count - i))
+        for removed_position in removed:
+            if removed_position > position:
+                break
+            position += 1
+        bisect.insort(removed, position)
+        result[i] = position
+
+    return result
+
+
+def sample_index(index, max_count, seed_compatible=False):
     """
-    initializes the random generator with a fixed seed
+    returns max_count random elements of the index (see sample_positions)
     """
-    rnd.seed(34758139)
+    return index[sample_positions(len(index), max_count, seed_compatible)]
+
+
+def sample_pairs(index_1, index_2, sample_count, exclude_index=None):
+    """
+    draws sample_count distinct random pairs of the ids of index_1 and index_2 without creating
+    the full index. Pairs contained in exclude_index are rejected. The pair positions are drawn
+    with a numpy generator seeded by the random generator, so the sample is reproducible
+    :return: multiindex of the sampled pairs
+    """
+    count_1 = len(index_1)
+    count_2 = len(index_2)
+
+    # keys (position_1 * count_2 + position_2) of the excluded pairs
+    excluded_keys = np.array([], dtype=np.int64)
+    if exclude_index is not None and len(exclude_index) > 0:
+        positions_1 = index_1.get_indexer(exclude_index.get_level_values(0))
+        positions_2 = index_2.get_indexer(exclude_index.get_level_values(1))
+        valid = (positions_1 >= 0) & (positions_2 >= 0)
+        excluded_keys = np.unique(positions_1[valid].astype(np.int64) * count_2 + positions_2[valid])
+
+    total_count = count_1 * count_2 - len(excluded_keys)
+    assert (sample_count <= total_count), "sample_count is greater then the count of pairs"
+
+    generator = np.random.default_rng(rnd.getrandbits(64))
+    if sample_count * 2 > total_count:
+        # most pairs are sampled, so draw from all keys
+        keys = np.setdiff1d(np.arange(count_1 * count_2, dtype=np.int64), excluded_keys)
+        keys = generator.choice(keys, sample_count, replace=False)
+    else:
+        # draw random keys and reject excluded and duplicate keys until the sample is complete
+        keys = np.array([], dtype=np.int64)
+        while len(keys) < sample_count:
+            drawn = generator.integers(0, count_1 * count_2, size=(sample_count - len(keys)) * 2, dtype=np.int64)
+            drawn = drawn[~np.isin(drawn, excluded_keys)]
+            keys = pd.unique(np.concatenate([keys, drawn]))[:sample_count]
+
+    return pd.MultiIndex.from_arrays([index_1.values.take(keys // count_2), index_2.values.take(keys % count_2)])
 
 
 def init_bin_top(max_value, bin_count):
@@ -192,30 +399,47 @@ def init_bin_top(max_value, bin_count):
     return bins
 
 
-def bin_values(bin_top, series):
+def round_values(values, digits):
     """
-    puts the count of values into the bins
+    rounds the values of the numpy array like the python round function
     """
-    # init result
-    bin_count = len(bin_top)
-    result = [0] * bin_count
+    values = np.asarray(values, dtype=np.float64)
+    result = np.round(values, digits)
+
+    # np.round can differ from round, if a value is (nearly) in the middle of two rounded values
+    scaled = np.abs(values) * 10 ** digits
+    ambiguous = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for position in zip(*np.nonzero(ambiguous)):
+        result[position] = round(float(values[position]), digits)
+
+    return result
+
 
-    # start binning
-    i = 0
-    for value in series.sort_values():
-        # check if the index of the bin is valid
-        while i < bin_count and bin_top[i] < round(value, 6):
-            i += 1
+def count_bins(bin_top, rounded_values, series_count):
+    """
+    puts the count of the rounded values into the bins and normalizes the counts using the series_count.
+    A value belongs to the first bin with a bin_top greater or equal than the value.
+    Missing values are counted in the bin of the greatest value
+    """
+    bin_count = len(bin_top)
+    is_missing = np.isnan(rounded_values)
+    positions = np.searchsorted(np.asarray(bin_top, dtype=np.float64), rounded_values[~is_missing], side="left")
+    if (positions >= bin_count).any():
+        raise IndexError("value greater than the last bin_top")
 
-        # increment the bin_count
-        result[i] += 1
+    result = np.bincount(positions, minlength=bin_count)
+    if is_missing.any():
+        result[positions.max() if len(positions) > 0 else 0] += is_missing.sum()
 
     # normalize values
-    series_count = len(series)
-    for i, val in enumerate(result):
-        result[i] = round(val / series_count, 6)
+    return [round(int(val) / series_count, 6) for val in result]
 
-    return result
+
+def bin_values(bin_top, series):
+    """
+    puts the count of values into the bins
+    """
+    return count_bins(bin_top, round_values(series.values, 6), len(series))
 
 
 def series_to_bins(series_match, series_distinct, bin_count):
@@ -240,10 +464,198 @@ def series_to_bins(series_match, series_distinct, bin_count):
         columns=['bin_top', 'Match', 'Non-Match'])
 
 
+def dataframe_to_bins(df_match, df_distinct, bin_count):
+    """
+    splits the values of each column of the dataframes to bin_count bins (like series_to_bins).
+    The values of all columns are rounded at once
+    :return: dictionary containing the binned dataframe of each column
+    """
+    df_distinct = df_distinct[df_match.columns]
+    rounded_match = round_values(df_match.values, 6)
+    rounded_distinct = round_values(df_distinct.values, 6)
+
+    result = OrderedDict()
+    for i, column in enumerate(df_match.columns):
+        # create bin_top
+        max_value = round(pd.Series([df_match[column].max(), df_distinct[column].max()]).max(), 6)
+        bin_top = init_bin_top(max_value, bin_count)
+
+        result[column] = pd.DataFrame({
+            "bin_top": pd.Series(bin_top),
+            "Match": pd.Series(count_bins(bin_top, rounded_match[:, i], len(df_match))),
+            "Non-Match": pd.Series(count_bins(bin_top, rounded_distinct[:, i], len(df_distinct)))},
+            columns=['bin_top', 'Match', 'Non-Match'])
+
+    return result
+
+
+class LRUCache:
+    """
+    Cache with a maximum count of entries. If the count is exceeded,
+    the least recently used entry is removed
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def get(self, key, create_value):
+        """
+        returns the cached value of the key.
+        If the key isn't cached, the value is created by calling create_value and added to the cache
+        """
+        if key in self.data:
+            self.data.move_to_end(key)
+            return self.data[key]
+
+        value = create_value()
+        if self.max_size > 0:
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class CompactRecord(Mapping):
+    """
+    Read only record with the mapping interface of a dict.
+    The values are stored in a tuple, the positions of the fields are shared by all records of a file
+    """
+    __slots__ = ("field_positions", "_values")
+
+    def __init__(self, field_positions, values):
+        self.field_positions = field_positions
+        self._values = tuple(values)
+
+    def __getitem__(self, fieldname):
+        return self._values[self.field_positions[fieldname]]
+
+    def __iter__(self):
+        return iter(self.field_positions)
+
+    def __len__(self):
+        return len(self.field_positions)
+
+    def __repr__(self):
+        return "CompactRecord({0})".format(dict(self.items()))
+
+    def __getstate__(self):
+        return self.field_positions, self._values
+
+    def __setstate__(self, state):
+        self.field_positions, self._values = state
+
+
+class PairKeySet:
+    """
+    Set of the pairs of two lists of records (the second list contains count_2 records). A pair is stored as
+    the int64 key position_1 * count_2 + position_2. The keys are kept in sorted runs of unique keys, a new run
+    is merged with the last run while the last run isn't longer, so the set needs 8 bytes per added pair and
+    there are at most log2(count) runs to search
+    """
+    def __init__(self, count_2):
+        self.count_2 = count_2
+        self.runs = []
+        self.count = 0
+
+    def contains_keys(self, keys):
+        """
+        :return: boolean array, which keys are in the set
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[positions] == keys
+        return found
+
+    def add(self, positions_1, positions_2):
+        """
+        adds the pairs of the position arrays
+        :return: boolean array, which pairs are new (the first of equal new pairs is marked as new)
+        """
+        keys = np.asarray(positions_1, dtype=np.int64) * self.count_2 + np.asarray(positions_2, dtype=np.int64)
+        unique_keys, first_positions = np.unique(keys, return_index=True)
+        unique_new = ~self.contains_keys(unique_keys)
+        is_new = np.zeros(len(keys), dtype=bool)
+        is_new[first_positions[unique_new]] = True
+
+        run = unique_keys[unique_new]
+        if len(run) > 0:
+            self.count += len(run)
+            while self.runs and len(self.runs[-1]) <= len(run):
+                run = np.sort(np.concatenate((self.runs.pop(), run)), kind="mergesort")
+            self.runs.append(run)
+        return is_new
+
+    def __contains__(self, pair):
+        return bool(self.contains_keys(np.array([pair[0] * self.count_2 + pair[1]], dtype=np.int64))[0])
+
+    def __len__(self):
+        return self.count
+
+
 def save_csv(df, filename, index=True):
     df.to_csv(filename, index=index, decimal=',', sep=';')
 
 
+def link_canopy_shard(matrix_a, start, matrix_b_t, threshold_add, threshold_remove, chunk_size):
+    """
+    calculates the canopy pairs of the bigram matrix matrix_a (starting at the position start of df_a)
+    and the transposed bigram matrix of df_b.
+    :return: positions of the pairs in df_a, positions of the pairs in df_b and
+    the position of the df_a record, that removed the df_b record (max int64 = not removed)
+    """
+    size_a = np.diff(matrix_a.indptr)
+    size_b = np.diff(matrix_b_t.indptr)
+
+    removed_by = np.full(matrix_b_t.shape[1], np.iinfo(np.int64).max, dtype=np.int64)
+    pairs_a = [np.array([], dtype=np.int64)]
+    pairs_b = [np.array([], dtype=np.int64)]
+    for chunk_start in range(0, matrix_a.shape[0], chunk_size):
+        intersection = matrix_a[chunk_start:chunk_start + chunk_size].dot(matrix_b_t).tocoo()
+        rows = intersection.row.astype(np.int64) + chunk_start
+        cols = intersection.col.astype(np.int64)
+        counts = intersection.data.astype(np.float64)
+        sim = counts / (size_a[rows] + size_b[cols] - counts)
+
+        # update the removed records with the first removing record of the chunk
+        add = sim > threshold_add
+        remove = add & (sim > threshold_remove)
+        np.minimum.at(removed_by, cols[remove], rows[remove] + start)
+
+        # keep the pairs, that were added before (or by) the removing record
+        keep = add & (rows + start <= removed_by[cols])
+        pairs_a.append(rows[keep] + start)
+        pairs_b.append(cols[keep])
+
+    return np.concatenate(pairs_a), np.concatenate(pairs_b), removed_by
+
+
+# df_b data of the canopy worker processes (set by init_canopy_worker)
+canopy_worker_data = {}
+
+
+def init_canopy_worker(matrix_b_t, threshold_add, threshold_remove, chunk_size):
+    """
+    initializes a canopy worker process
+    """
+    canopy_worker_data["matrix_b_t"] = matrix_b_t
+    canopy_worker_data["threshold_add"] = threshold_add
+    canopy_worker_data["threshold_remove"] = threshold_remove
+    canopy_worker_data["chunk_size"] = chunk_size
+
+
+def canopy_worker(shard):
+    """
+    calculates the canopy pairs of a shard (matrix_a, start) in a worker process
+    """
+    matrix_a, start = shard
+    return link_canopy_shard(matrix_a, start, canopy_worker_data["matrix_b_t"], canopy_worker_data["threshold_add"],
+                             canopy_worker_data["threshold_remove"], canopy_worker_data["chunk_size"])
+
+
 class CanopyClusterIndex(BaseIndexator):
     """Canopy clustering for indexing"""
 
@@ -263,25 +675,114 @@ class CanopyClusterIndex(BaseIndexator):
         else:
             return 0
 
+    @staticmethod
+    def encode_bigrams(values, vocabulary):
+        """
+        returns the bigrams of the values as (indptr, indices) of a sparse matrix.
+        each row contains the bigram numbers of one value. new bigrams are added to the vocabulary
+        """
+        indptr = [0]
+        indices = []
+        for value in values:
+            if isinstance(value, str):
+                for bigram in CanopyClusterIndex.buildbigram(value):
+                    indices.append(vocabulary.setdefault(bigram, len(vocabulary)))
+            indptr.append(len(indices))
+        return indptr, indices
+
+    @staticmethod
+    def bigram_matrix(encoded_bigrams, bigram_count):
+        """
+        creates the binary csr matrix of the encoded bigrams
+        """
+        indptr, indices = encoded_bigrams
+        data = np.ones(len(indices), dtype=np.int32)
+        return sparse.csr_matrix((data, np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+                                 shape=(len(indptr) - 1, bigram_count))
+
     def __init__(self,
                  left_on=None,
                  right_on=None,
                  threshold_add=0.3,
                  threshold_remove=0.8,
+                 engine="sparse",
+                 chunk_size=1000,
+                 n_jobs=1,
+                 parallel_mode="deterministic",
                  **kwargs):
         super(CanopyClusterIndex, self).__init__(**kwargs)
 
         if right_on is None:
             right_on = left_on
 
+        if engine not in ("sparse", "python"):
+            raise ValueError("engine {0} is invalid: must be sparse or python".format(engine))
+        if parallel_mode not in ("deterministic", "relaxed"):
+            raise ValueError("parallel_mode {0} is invalid: must be deterministic or relaxed".format(parallel_mode))
+        if n_jobs > 1 and engine != "sparse":
+            raise ValueError("n_jobs greater than 1 is only supported by the sparse engine")
+
         # variables to block on
         self.left_on = left_on
         self.right_on = right_on
         self.threshold_add = threshold_add
         self.threshold_remove = threshold_remove
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.parallel_mode = parallel_mode
 
     def _link_index(self, df_a, df_b):
         """Make pairs ."""
+        if self.engine == "sparse":
+            return self._link_index_sparse(df_a, df_b)
+        return self._link_index_python(df_a, df_b)
+
+    def _link_index_sparse(self, df_a, df_b):
+        """
+        Make pairs using sparse matrix products.
+        The intersection sizes of the bigram sets are calculated for chunk_size records of df_a at once.
+        A record of df_b is removed by the first record of df_a (in the order of df_a) with a
+        similarity above threshold_remove, so the pairs are identical to _link_index_python.
+
+        If n_jobs is greater than 1, df_a is split into n_jobs shards, that are processed in a process pool.
+        parallel_mode "deterministic" merges the removed records of all shards and returns the same
+        pairs as the sequential run. parallel_mode "relaxed" only removes records within a shard, so a
+        record of df_b removed by a record of an earlier shard is still paired in the later shards. The
+        result is a superset of the sequential result (more pairs, never less).
+        """
+        vocabulary = {}
+        encoded_a = CanopyClusterIndex.encode_bigrams(df_a[self.left_on], vocabulary)
+        encoded_b = CanopyClusterIndex.encode_bigrams(df_b[self.right_on], vocabulary)
+        matrix_a = CanopyClusterIndex.bigram_matrix(encoded_a, len(vocabulary))
+        matrix_b_t = CanopyClusterIndex.bigram_matrix(encoded_b, len(vocabulary)).transpose().tocsc()
+
+        if self.n_jobs > 1 and len(df_a) > 1:
+            # process the shards in a process pool. matrix_b_t is passed once per worker process
+            shard_bounds = np.linspace(0, len(df_a), self.n_jobs + 1).astype(np.int64)
+            shards = [(matrix_a[start:stop], start) for start, stop in zip(shard_bounds[:-1], shard_bounds[1:])]
+            with multiprocessing.Pool(self.n_jobs, init_canopy_worker,
+                                      (matrix_b_t, self.threshold_add, self.threshold_remove, self.chunk_size)) as pool:
+                shard_results = pool.map(canopy_worker, shards)
+
+            pairs_a = np.concatenate([result[0] for result in shard_results])
+            pairs_b = np.concatenate([result[1] for result in shard_results])
+            if self.parallel_mode == "deterministic":
+                # remove the pairs, that were added after the first removing record of all shards
+                removed_by = np.minimum.reduce([result[2] for result in shard_results])
+                keep = pairs_a <= removed_by[pairs_b]
+                pairs_a = pairs_a[keep]
+                pairs_b = pairs_b[keep]
+        else:
+            pairs_a, pairs_b, removed_by = link_canopy_shard(matrix_a, 0, matrix_b_t, self.threshold_add,
+                                                             self.threshold_remove, self.chunk_size)
+
+        result = pd.MultiIndex.from_arrays([df_a.index.values.take(pairs_a), df_b.index.values.take(pairs_b)],
+                                           names=[df_a.index.name, df_b.index.name])
+        return result.drop_duplicates()
+
+    def _link_index_python(self, df_a, df_b):
+        """Make pairs ."""
 
         result = set()
 
@@ -315,3 +816,193 @@ class CanopyClusterIndex(BaseIndexator):
                             del data_dict[idx_b]
 
         return pd.MultiIndex.from_tuples(result, names=[df_a.index.name, df_b.index.name])
+
+
+class FullIndex(BaseIndexator):
+    """
+    Full index (cartesian product) of the records of both data files.
+    Besides the full multiindex, the pairs can be created lazily in blocks of block_size pairs
+    (in the row order of df_a), so the full index never has to be held in memory
+    """
+
+    def __init__(self, block_size=100000, **kwargs):
+        super(FullIndex, self).__init__(**kwargs)
+        self.block_size = block_size
+
+    @staticmethod
+    def pair_count(df_a, df_b):
+        """
+        returns the count of pairs of the full index
+        """
+        return len(df_a) * len(df_b)
+
+    @staticmethod
+    def contains(df_a, df_b, index):
+        """
+        returns a boolean array, which pairs of the index are contained in the full index
+        """
+        return index.get_level_values(0).isin(df_a.index) & index.get_level_values(1).isin(df_b.index)
+
+    def index_blocks(self, df_a, df_b):
+        """
+        yields the pairs of the full index as multiindexes of block_size pairs
+        """
+        count_b = len(df_b)
+        for start in range(0, self.pair_count(df_a, df_b), self.block_size):
+            keys = np.arange(start, min(start + self.block_size, self.pair_count(df_a, df_b)), dtype=np.int64)
+            yield pd.MultiIndex.from_arrays([df_a.index.values.take(keys // count_b),
+                                             df_b.index.values.take(keys % count_b)],
+                                            names=[df_a.index.name, df_b.index.name])
+
+    def _link_index(self, df_a, df_b):
+        """Make pairs ."""
+        return pd.MultiIndex.from_product([df_a.index.values, df_b.index.values],
+                                          names=[df_a.index.name, df_b.index.name])
+
+
+class MinHashLSHIndex(BaseIndexator):
+    """
+    MinHash locality sensitive hashing for indexing.
+    The shingles (bigrams or tokens) of each value are hashed with bands * rows seeded hash functions,
+    the minimum of each hash function is the MinHash signature of the value. The signatures are split
+    into bands of rows values, two records are paired, if their signatures are equal in at least one band.
+    Records with empty values are never paired
+    """
+
+    # prime of the universal hash functions (a * x + b) % HASH_PRIME
+    HASH_PRIME = (1 << 31) - 1
+
+    @staticmethod
+    def encode_tokens(values, vocabulary):
+        """
+        returns the tokens of the values as (indptr, indices) like CanopyClusterIndex.encode_bigrams
+        """
+        indptr = [0]
+        indices = []
+        for value in values:
+            if isinstance(value, str):
+                for token in set(value.lower().split()):
+                    indices.append(vocabulary.setdefault(token, len(vocabulary)))
+            indptr.append(len(indices))
+        return indptr, indices
+
+    @staticmethod
+    def pair_probability(similarity, bands, rows):
+        """
+        returns the probability, that two values with the jaccard similarity of their shingles are paired
+        """
+        return 1 - (1 - similarity ** rows) ** bands
+
+    def __init__(self,
+                 left_on=None,
+                 right_on=None,
+                 bands=30,
+                 rows=3,
+                 shingles="bigram",
+                 seed=RANDOM_SEED,
+                 **kwargs):
+        super(MinHashLSHIndex, self).__init__(**kwargs)
+
+        if right_on is None:
+            right_on = left_on
+
+        if shingles not in ("bigram", "token"):
+            raise ValueError("shingles {0} is invalid: must be bigram or token".format(shingles))
+
+        # variables to block on
+        self.left_on = left_on
+        self.right_on = right_on
+        self.bands = bands
+        self.rows = rows
+        self.shingles = shingles
+        self.seed = seed
+
+    def signatures(self, encoded_values, shingle_hashes):
+        """
+        returns the MinHash signatures of the encoded values (one row per value) and
+        a boolean array, which values have shingles
+        """
+        indptr, indices = encoded_values
+        indptr = np.array(indptr, dtype=np.int64)
+        has_shingles = np.diff(indptr) > 0
+        signatures = np.zeros((len(indptr) - 1, shingle_hashes.shape[1]), dtype=np.uint32)
+        if has_shingles.any():
+            hashes = shingle_hashes[np.array(indices, dtype=np.int64)]
+            signatures[has_shingles] = np.minimum.reduceat(hashes, indptr[:-1][has_shingles], axis=0)
+        return signatures, has_shingles
+
+    def _link_index(self, df_a, df_b):
+        """Make pairs ."""
+        vocabulary = {}
+        encode = CanopyClusterIndex.encode_bigrams if self.shingles == "bigram" else MinHashLSHIndex.encode_tokens
+        encoded_a = encode(df_a[self.left_on], vocabulary)
+        encoded_b = encode(df_b[self.right_on], vocabulary)
+
+        # hash each shingle once with all hash functions. The hash functions are applied to the crc32 of
+        # the shingle (the vocabulary numbers depend on the set order and so on PYTHONHASHSEED)
+        random_state = np.random.RandomState(self.seed)
+        hash_count = self.bands * self.rows
+        factors = random_state.randint(1, self.HASH_PRIME, size=hash_count).astype(np.uint64)
+        offsets = random_state.randint(0, self.HASH_PRIME, size=hash_count).astype(np.uint64)
+        shingle_values = np.zeros(len(vocabulary), dtype=np.uint64)
+        for shingle, number in vocabulary.items():
+            shingle_values[number] = zlib.crc32(shingle.encode("utf-8")) % self.HASH_PRIME
+        shingle_hashes = ((shingle_values[:, None] * factors + offsets) % self.HASH_PRIME).astype(np.uint32)
+
+        signatures_a, has_shingles_a = self.signatures(encoded_a, shingle_hashes)
+        signatures_b, has_shingles_b = self.signatures(encoded_b, shingle_hashes)
+        positions_a = np.flatnonzero(has_shingles_a)
+        positions_b = np.flatnonzero(has_shingles_b)
+
+        # pair the records with equal band signatures (keys: position_a * len(df_b) + position_b)
+        keys = []
+        for band in range(self.bands):
+            columns = slice(band * self.rows, (band + 1) * self.rows)
+            band_signatures = np.concatenate([signatures_a[positions_a, columns], signatures_b[positions_b, columns]])
+            band_signatures = np.ascontiguousarray(band_signatures).view(np.dtype((np.void, 4 * self.rows))).ravel()
+            buckets = np.unique(band_signatures, return_inverse=True)[1].ravel()
+            band_pairs = pd.DataFrame({"bucket": buckets[:len(positions_a)], "a": positions_a}).merge(
+                pd.DataFrame({"bucket": buckets[len(positions_a):], "b": positions_b}), on="bucket")
+            keys.append(band_pairs["a"].values.astype(np.int64) * len(df_b) + band_pairs["b"].values)
+        keys = np.unique(np.concatenate(keys)) if keys else np.array([], dtype=np.int64)
+
+        return pd.MultiIndex.from_arrays([df_a.index.values.take(keys // len(df_b)),
+                                          df_b.index.values.take(keys % len(df_b))],
+                                         names=[df_a.index.name, df_b.index.name])
+
+
+class UnionIndex(BaseIndexator):
+    """
+    Union of the pairs of several indexers (multi-pass blocking).
+    The pairs are unioned as integer keys (position_a * len(df_b) + position_b), so the records of
+    both data frames need unique ids. After indexing, statistics contains the pair counts of each
+    indexer, the count of pairs only found by each indexer and the count of pairs found by more than one indexer
+    """
+
+    def __init__(self, indexers, **kwargs):
+        super(UnionIndex, self).__init__(**kwargs)
+        self.indexers = indexers
+        self.statistics = {}
+
+    def _link_index(self, df_a, df_b):
+        """Make pairs ."""
+        indexer_keys = []
+        for indexer in self.indexers:
+            pairs = indexer.index(df_a, df_b)
+            positions_a = df_a.index.get_indexer(pairs.get_level_values(0))
+            positions_b = df_b.index.get_indexer(pairs.get_level_values(1))
+            indexer_keys.append(np.unique(positions_a.astype(np.int64) * len(df_b) + positions_b))
+
+        keys, indexer_counts = np.unique(np.concatenate(indexer_keys), return_counts=True)
+        exclusive_keys = keys[indexer_counts == 1]
+
+        self.statistics = OrderedDict()
+        for number, current_keys in enumerate(indexer_keys):
+            self.statistics["Index_{0}_pairs".format(number + 1)] = len(current_keys)
+            self.statistics["Index_{0}_exclusive_pairs".format(number + 1)] = int(
+                np.isin(current_keys, exclusive_keys, assume_unique=True).sum())
+        self.statistics["Index_overlap_pairs"] = int((indexer_counts > 1).sum())
+
+        return pd.MultiIndex.from_arrays([df_a.index.values.take(keys // len(df_b)),
+                                          df_b.index.values.take(keys % len(df_b))],
+                                         names=[df_a.index.name, df_b.index.name])